@@ -60,6 +60,17 @@ def collision_test(b1, p1, b2, p2):
                             get_block_interval(b2, p2))
 
 
+def batch_collision_test(input_values):
+    # Vectorized collision_test over a list of (b1, p1, b2, p2) tuples
+    if not input_values:
+        return np.zeros(0, dtype=bool)
+    b1s, p1s, b2s, p2s = zip(*input_values)
+    x1s = np.array([p1[0] for p1 in p1s])
+    x2s = np.array([p2[0] for p2 in p2s])
+    different = np.array([b1 != b2 for b1, b2 in zip(b1s, b2s)])
+    return different & (np.abs(x1s - x2s) <= BLOCK_WIDTH)
+
+
 def distance_fn(q1, q2):
     ord = 1  # 1 | 2
     return MOVE_COST + COST_PER_DIST*np.linalg.norm(q2 - q1, ord=ord)
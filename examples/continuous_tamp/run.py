@@ -11,7 +11,8 @@ from itertools import product
 
 from pddlstream.algorithms.meta import solve, create_parser
 from examples.continuous_tamp.optimizer.optimizer import cfree_motion_fn, get_optimize_fn
-from examples.continuous_tamp.primitives import get_pose_gen, collision_test, distance_fn, inverse_kin_fn, \
+from examples.continuous_tamp.primitives import get_pose_gen, distance_fn, inverse_kin_fn, \
+    batch_collision_test, \
     get_region_test, plan_motion, PROBLEMS, draw_state, get_random_seed, SUCTION_HEIGHT, MOVE_COST, GRASP, \
     update_state, ENVIRONMENT_NAMES, STOVE_NAMES, duration_fn
 from pddlstream.algorithms.downward import get_cost_scale
@@ -21,7 +22,8 @@ from pddlstream.algorithms.visualization import VISUALIZATIONS_DIR
 from pddlstream.language.external import defer_shared, get_defer_all_unbound, get_defer_any_unbound
 from pddlstream.language.constants import And, Equal, PDDLProblem, TOTAL_COST, print_solution, Or, Output
 from pddlstream.language.function import FunctionInfo
-from pddlstream.language.generator import from_gen_fn, from_list_fn, from_test, from_fn
+from pddlstream.language.generator import from_gen_fn, from_list_fn, from_test, from_fn, from_batch_test
+from pddlstream.language.parallel import WorkerPool
 from pddlstream.language.stream import StreamInfo
 from pddlstream.language.temporal import get_end, compute_duration, retime_plan
 from pddlstream.utils import ensure_dir, safe_rm_dir, user_input, read, INF, get_file_path, str_from_object, \
@@ -85,7 +87,14 @@ def create_problem(tamp_problem, hand_empty=False, manipulate_cost=1.):
 
     return init, goal
 
-def pddlstream_from_tamp(tamp_problem, use_stream=True, use_optimizer=False, collisions=True):
+def get_cfree_batch_test(collisions=True):
+    def batch_test(input_values):
+        if not collisions:
+            return np.ones(len(input_values), dtype=bool)
+        return ~batch_collision_test(input_values)
+    return batch_test
+
+def pddlstream_from_tamp(tamp_problem, use_stream=True, use_optimizer=False, collisions=True, pool=None):
 
     domain_pddl = read(get_file_path(__file__, 'domain.pddl'))
     external_paths = []
@@ -103,7 +112,7 @@ def pddlstream_from_tamp(tamp_problem, use_stream=True, use_optimizer=False, col
         #'s-ik': from_gen_fn(unreliable_ik_fn),
         's-motion': from_fn(plan_motion),
         't-region': from_test(get_region_test(tamp_problem.regions)),
-        't-cfree': from_test(lambda *args: implies(collisions, not collision_test(*args))),
+        't-cfree': from_batch_test(get_cfree_batch_test(collisions)),
         'dist': distance_fn,
         'duration': duration_fn, # temporal
     }
@@ -113,6 +122,10 @@ def pddlstream_from_tamp(tamp_problem, use_stream=True, use_optimizer=False, col
             'gurobi': from_list_fn(get_optimize_fn(tamp_problem.regions, collisions=collisions)),
             'rrt': from_fn(cfree_motion_fn),
         })
+    if pool is not None:
+        # Samples poses within the processes of a WorkerPool
+        stream_map['s-region'] = pool.get_gen_fn('examples.continuous_tamp.primitives', 'get_pose_gen',
+                                                 args=(tamp_problem.regions,), conversion='from_gen_fn')
     #stream_map = 'debug'
 
     init, goal = create_problem(tamp_problem)
@@ -121,6 +134,25 @@ def pddlstream_from_tamp(tamp_problem, use_stream=True, use_optimizer=False, col
 
 ##################################################
 
+def get_stream_info(cfree=False):
+    # TODO: test if placed in the same region
+    defer_fn = defer_shared # never_defer | defer_unique | defer_shared
+    return {
+        's-region': StreamInfo(defer_fn=defer_fn),
+        's-grasp': StreamInfo(defer_fn=defer_fn),
+        's-ik': StreamInfo(defer_fn=get_defer_all_unbound(inputs='?g')), # defer_fn | defer_unbound
+        's-motion': StreamInfo(defer_fn=get_defer_any_unbound()),
+        't-cfree': StreamInfo(defer_fn=get_defer_any_unbound(), eager=False, verbose=False, # defer_fn |  defer_unbound
+                              batch_test=get_cfree_batch_test(collisions=not cfree)),
+        't-region': StreamInfo(eager=True, p_success=0),  # bound_fn is None
+        'dist': FunctionInfo(eager=False, defer_fn=get_defer_any_unbound(), opt_fn=lambda q1, q2: MOVE_COST),
+        'gurobi-cfree': StreamInfo(eager=False, negate=True), # TODO: AttributeError: 'tuple' object has no attribute 'instance'
+        #'gurobi': OptimizerInfo(p_success=0),
+        #'rrt': OptimizerInfo(p_success=0),
+    }
+
+##################################################
+
 def display_plan(tamp_problem, plan, display=True, save=False, time_step=0.025, sec_per_step=1e-3):
     from examples.continuous_tamp.viewer import ContinuousTMPViewer
     from examples.discrete_tamp.viewer import COLORS
@@ -224,22 +256,10 @@ def main():
     parser.add_argument('-g', '--gurobi', action='store_true', help='Uses gurobi')
     parser.add_argument('-o', '--optimal', action='store_true', help='Runs in an anytime mode')
     parser.add_argument('-s', '--skeleton', action='store_true', help='Enforces skeleton plan constraints')
+    parser.add_argument('-w', '--workers', default=0, type=int, help='The number of stream worker processes')
     tamp_problem, args = initialize(parser)
 
-    # TODO: test if placed in the same region
-    defer_fn = defer_shared # never_defer | defer_unique | defer_shared
-    stream_info = {
-        's-region': StreamInfo(defer_fn=defer_fn),
-        's-grasp': StreamInfo(defer_fn=defer_fn),
-        's-ik': StreamInfo(defer_fn=get_defer_all_unbound(inputs='?g')), # defer_fn | defer_unbound
-        's-motion': StreamInfo(defer_fn=get_defer_any_unbound()),
-        't-cfree': StreamInfo(defer_fn=get_defer_any_unbound(), eager=False, verbose=False), # defer_fn |  defer_unbound
-        't-region': StreamInfo(eager=True, p_success=0),  # bound_fn is None
-        'dist': FunctionInfo(eager=False, defer_fn=get_defer_any_unbound(), opt_fn=lambda q1, q2: MOVE_COST),
-        'gurobi-cfree': StreamInfo(eager=False, negate=True), # TODO: AttributeError: 'tuple' object has no attribute 'instance'
-        #'gurobi': OptimizerInfo(p_success=0),
-        #'rrt': OptimizerInfo(p_success=0),
-    }
+    stream_info = get_stream_info(cfree=args.cfree)
     #stream_info = {}
 
     hierarchy = [
@@ -257,8 +277,9 @@ def main():
     replan_actions = set()
     #replan_actions = {'move', 'pick', 'place'}
 
+    pool = WorkerPool(num_workers=args.workers) if args.workers else None
     pddlstream_problem = pddlstream_from_tamp(tamp_problem, collisions=not args.cfree,
-                                              use_stream=not args.gurobi, use_optimizer=args.gurobi)
+                                              use_stream=not args.gurobi, use_optimizer=args.gurobi, pool=pool)
     dump_pddlstream(pddlstream_problem)
 
     success_cost = 0 if args.optimal else INF
@@ -276,6 +297,8 @@ def main():
                          unit_costs=args.unit, success_cost=success_cost,
                          unit_efforts=True, effort_weight=effort_weight,
                          search_sample_ratio=1, visualize=args.visualize) # TODO: solve_serialized
+    if pool is not None:
+        pool.close()
 
     print_solution(solution)
     plan, cost, evaluations = solution
@@ -0,0 +1,95 @@
+from __future__ import print_function
+
+from pddlstream.algorithms.downward import DEFAULT_MAX_TIME
+from pddlstream.language.statistics import Allocation, load_allocation, write_allocation, safe_ratio
+from pddlstream.utils import clip
+
+SMOOTHING = 0.5 # Weight of the latest iteration within the moving averages
+RATIO_STEP = 0.5 # Multiplicative change of search_sample_ratio per iteration
+MIN_RATIO = 1e-2
+MAX_RATIO = 1e2
+MIN_PLANNER_TIME = 1.
+MAX_PLANNER_TIME = 5*60
+PLANNER_TIME_SCALE = 4. # The planner time budget as a multiple of the average successful search time
+TIMEOUT_FRACTION = 0.9 # Unsuccessful searches that use this fraction of the budget are considered timeouts
+MIN_SAMPLE_TIME = 1e-3 # Shorter sampling phases are not informative
+
+# TODO: adapt the complexity step and max_skeletons as well
+
+def update_average(average, value, smoothing=SMOOTHING):
+    if average is None:
+        return value
+    return (1 - smoothing) * average + smoothing * value
+
+class AllocationController(object):
+    """
+    Adapts the search_sample_ratio and max_planner_time of solve_abstract online.
+    The ratio hill climbs the rate of new facts per second of search and sampling. By the marginal value theorem,
+    this rate is maximized when the marginal rate of sampling equals it.
+    """
+    def __init__(self, search_sample_ratio, max_planner_time=DEFAULT_MAX_TIME, pddl_name=None, verbose=True):
+        self.search_sample_ratio = clip(search_sample_ratio, MIN_RATIO, MAX_RATIO)
+        self.max_planner_time = clip(max_planner_time, MIN_PLANNER_TIME, MAX_PLANNER_TIME)
+        self.pddl_name = pddl_name
+        self.verbose = verbose
+        self.search_time = None # Moving average of the search time per iteration
+        self.success_time = None # Moving average of the successful search time
+        self.sample_rate = None # Moving average of the new facts per second of sampling
+        self.overall_rate = None # Moving average of the new facts per second of search and sampling
+        self.last_search_time = 0.
+        self.direction = +1 # Whether the ratio is increasing or decreasing
+        self.num_searches = 0
+        self.num_successes = 0
+        self.num_timeouts = 0
+    @property
+    def allocation(self):
+        return Allocation(self.search_sample_ratio, self.max_planner_time)
+    def load(self):
+        if self.pddl_name is None:
+            return None
+        allocation = load_allocation(self.pddl_name)
+        if allocation is not None:
+            self.search_sample_ratio, self.max_planner_time = allocation
+            if self.verbose:
+                print('Loaded allocation:', allocation)
+        return allocation
+    def write(self):
+        if (self.pddl_name is None) or (self.num_searches == 0):
+            return None
+        return write_allocation(self.pddl_name, self.allocation, verbose=self.verbose)
+    def update_search(self, search_time, success):
+        self.num_searches += 1
+        self.last_search_time = search_time
+        self.search_time = update_average(self.search_time, search_time)
+        if success:
+            self.num_successes += 1
+            self.success_time = update_average(self.success_time, search_time)
+            self.max_planner_time = PLANNER_TIME_SCALE * self.success_time
+        elif TIMEOUT_FRACTION * self.max_planner_time <= search_time:
+            self.num_timeouts += 1
+            self.max_planner_time *= 2
+        self.max_planner_time = clip(self.max_planner_time, MIN_PLANNER_TIME, MAX_PLANNER_TIME)
+    def update_sample(self, sample_time, num_facts):
+        if sample_time < MIN_SAMPLE_TIME:
+            return self.search_sample_ratio
+        overall_rate = safe_ratio(num_facts, sample_time + self.last_search_time, undefined=0.)
+        if (self.overall_rate is not None) and (overall_rate < self.overall_rate):
+            self.direction *= -1 # The previous change decreased the rate
+        self.search_sample_ratio *= (1 + RATIO_STEP) ** self.direction
+        self.search_sample_ratio = clip(self.search_sample_ratio, MIN_RATIO, MAX_RATIO)
+        self.sample_rate = update_average(self.sample_rate, num_facts / sample_time)
+        self.overall_rate = update_average(self.overall_rate, overall_rate)
+        if self.verbose:
+            print('Sample rate: {:.3f} | Overall rate: {:.3f} | Search sample ratio: {:.3f} | '
+                  'Planner time: {:.3f}'.format(self.sample_rate, self.overall_rate,
+                                                self.search_sample_ratio, self.max_planner_time))
+        return self.search_sample_ratio
+    def export_summary(self):
+        return {
+            'search_sample_ratio': self.search_sample_ratio,
+            'max_planner_time': self.max_planner_time,
+            'searches': self.num_searches,
+            'timeouts': self.num_timeouts,
+        }
+    def __repr__(self):
+        return '{}{}'.format(self.__class__.__name__, tuple(self.allocation))
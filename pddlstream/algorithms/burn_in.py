@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import argparse
+import ast
+import importlib
+import random
+import time
+
+from collections import defaultdict
+
+import numpy as np
+
+from pddlstream.algorithms.algorithm import parse_problem, reset_globals
+from pddlstream.algorithms.common import SolutionStore
+from pddlstream.algorithms.incremental import process_instance
+from pddlstream.algorithms.instantiation import Instantiator
+from pddlstream.language.function import Function
+from pddlstream.language.statistics import load_stream_statistics, write_stream_statistics
+from pddlstream.language.stream import Stream
+from pddlstream.utils import INF, elapsed_time, str_from_object
+
+# TODO: sample inputs from stream outputs in proportion to how often they are used within skeletons
+
+def is_burnable(external):
+    # Fluent and negated streams are only meaningful with respect to a plan
+    if isinstance(external, Stream):
+        return not external.is_special
+    return isinstance(external, Function)
+
+def burn_in(problem, stream_info={}, max_calls=100, max_time=60, verbose=False):
+    """
+    Calls each stream on random inputs reachable from the initial state to calibrate its statistics.
+
+    :param problem: a PDDLProblem
+    :param stream_info: a dictionary from stream name to StreamInfo
+    :param max_calls: the maximum number of calls per stream
+    :param max_time: the maximum runtime
+    :param verbose: if True, print stream outputs
+    :return: a dictionary from stream name to its number of calls
+    """
+    start_time = time.time()
+    reset_globals()
+    evaluations, _, _, externals = parse_problem(problem, stream_info=stream_info)
+    externals = list(filter(is_burnable, externals))
+    load_stream_statistics(externals) # The written statistics accumulate with previous data
+    store = SolutionStore(evaluations, max_time, success_cost=INF, verbose=verbose)
+    instantiator = Instantiator(externals, evaluations)
+    instances_from_stream = defaultdict(list)
+    queued = set()
+    while not store.is_terminated():
+        while instantiator:
+            instance = instantiator.pop_stream()
+            if not instance.enumerated and (instance not in queued):
+                instances_from_stream[instance.external].append(instance)
+                queued.add(instance)
+        candidates = [external for external, instances in instances_from_stream.items()
+                      if instances and (external.online_calls < max_calls)]
+        if not candidates:
+            break
+        instances = instances_from_stream[random.choice(candidates)]
+        instance = instances.pop(random.randrange(len(instances)))
+        queued.remove(instance)
+        process_instance(instantiator, store, instance, verbose=verbose) # Re-pushes instance if not enumerated
+
+    write_stream_statistics(externals, verbose=True)
+    calls_from_stream = {external.name: external.online_calls for external in externals}
+    print('Calls: {} | Evaluations: {} | Sample time: {:.3f} | Time: {:.3f}'.format(
+        str_from_object(calls_from_stream), len(evaluations), store.sample_time, elapsed_time(start_time)))
+    return calls_from_stream
+
+##################################################
+
+def parse_arg(arg):
+    try:
+        return ast.literal_eval(arg)
+    except (ValueError, SyntaxError):
+        return arg
+
+def get_module_function(module, name):
+    # The examples list their problem functions within PROBLEMS
+    problem_from_name = {fn.__name__: fn for fn in getattr(module, 'PROBLEMS', [])}
+    if name in problem_from_name:
+        return problem_from_name[name]
+    return getattr(module, name)
+
+def main():
+    # e.g. python -m pddlstream.algorithms.burn_in examples.continuous_tamp.run \
+    #   -p tight -a 2 -f pddlstream_from_tamp -i get_stream_info
+    parser = argparse.ArgumentParser(description='Writes calibrated stream statistics for a problem')
+    parser.add_argument('module', type=str, help='The module defining the problem (e.g. examples.blocksworld.run)')
+    parser.add_argument('-f', '--function', type=str, default='get_problem',
+                        help='The function within module that returns a PDDLProblem given the output of --problem')
+    parser.add_argument('-p', '--problem', type=str, default=None,
+                        help='The function within module (or its PROBLEMS) that returns the input of --function')
+    parser.add_argument('-a', '--args', nargs='*', default=[],
+                        help='The arguments of --problem (or of --function without --problem)')
+    parser.add_argument('-i', '--info', type=str, default=None,
+                        help='The function within module that returns the stream_info without arguments')
+    parser.add_argument('-c', '--calls', type=int, default=100, help='The maximum number of calls per stream')
+    parser.add_argument('-t', '--max_time', type=float, default=60, help='The maximum runtime')
+    parser.add_argument('-s', '--seed', type=int, default=None, help='The random seed')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Prints stream outputs')
+    args = parser.parse_args()
+    print('Arguments:', args)
+    if args.seed is not None:
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+    module = importlib.import_module(args.module)
+    problem_fn = get_module_function(module, args.function)
+    fn_args = list(map(parse_arg, args.args))
+    if args.problem is None:
+        problem = problem_fn(*fn_args)
+    else:
+        problem = problem_fn(get_module_function(module, args.problem)(*fn_args))
+    stream_info = {} if args.info is None else get_module_function(module, args.info)()
+    burn_in(problem, stream_info=stream_info, max_calls=args.calls, max_time=args.max_time, verbose=args.verbose)
+
+if __name__ == '__main__':
+    main()
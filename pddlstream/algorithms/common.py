@@ -103,7 +103,12 @@ def add_facts(evaluations, facts, **kwargs):
 
 def add_certified(evaluations, result, **kwargs):
     complexity = result.compute_complexity(evaluations, **kwargs)
-    return add_facts(evaluations, result.get_certified(), result=result, complexity=complexity)
+    certified = result.get_certified()
+    new_evaluations = add_facts(evaluations, certified, result=result, complexity=complexity)
+    if getattr(result, 'duplicate', False):
+        # Facts shared with an equivalent output are not new, so they do not produce new downstream instances
+        result.external.deduplicator.num_facts += len(certified) - len(new_evaluations)
+    return new_evaluations
 
 
 def evaluations_from_init(init):
@@ -4,6 +4,7 @@ import os
 import re
 import sys
 import subprocess
+import threading
 from collections import namedtuple, defaultdict
 from time import time
 
@@ -410,8 +411,32 @@ def normalize_domain_goal(domain, goal_exp):
     normalize.normalize(task)
     return task
 
+class SearchHandle(object):
+    """
+    Lets another thread kill the search subprocess of run_search, including one that has not started yet.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.process = None
+        self.killed = False
+    def start(self, command):
+        with self.lock:
+            if self.killed:
+                return None
+            # exec replaces the shell, so killing the process kills the planner
+            self.process = subprocess.Popen('exec ' + command, stdout=subprocess.PIPE,
+                                            shell=True, cwd=None, close_fds=True)
+            return self.process
+    def kill(self):
+        with self.lock:
+            self.killed = True
+            if (self.process is not None) and (self.process.poll() is None):
+                self.process.kill()
+    def __repr__(self):
+        return '{}(killed={})'.format(self.__class__.__name__, self.killed)
+
 def run_search(temp_dir, planner=DEFAULT_PLANNER, max_planner_time=DEFAULT_MAX_TIME,
-               max_cost=INF, debug=False):
+               max_cost=INF, debug=False, handle=None):
     """
     Runs FastDownward's search phase on translated SAS+ problem TRANSLATE_OUTPUT
     :param temp_dir: the directory for temporary FastDownward input and output files
@@ -419,6 +444,7 @@ def run_search(temp_dir, planner=DEFAULT_PLANNER, max_planner_time=DEFAULT_MAX_T
     :param max_planner_time: the maximum runtime of FastDownward
     :param max_cost: the maximum FastDownward plan cost
     :param debug: If True, print the FastDownward search output
+    :param handle: if not None, a SearchHandle that can kill the search from another thread
     :return: a tuple (plan, cost) where plan is a sequence of PDDL actions
         (or None) and cost is the cost of the plan (INF if no plan)
     """
@@ -457,7 +483,12 @@ def run_search(temp_dir, planner=DEFAULT_PLANNER, max_planner_time=DEFAULT_MAX_T
         if filename.startswith(SEARCH_OUTPUT):
             safe_remove(os.path.join(temp_path, filename))
 
-    proc = subprocess.Popen(command, stdout=subprocess.PIPE, shell=True, cwd=None, close_fds=True)
+    if handle is None:
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE, shell=True, cwd=None, close_fds=True)
+    else:
+        proc = handle.start(command)
+        if proc is None: # Killed before starting
+            return None, INF
     output, error = proc.communicate()
     #if proc.returncode not in [0, 12]: # Good: [0, 12] | Bad: [127]
     #    raise RuntimeError(proc.returncode)
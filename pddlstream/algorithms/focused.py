@@ -1,31 +1,41 @@
 from __future__ import print_function
 
 import time
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError: # Python 2 without the futures backport
+    ThreadPoolExecutor = None
 
 from pddlstream.algorithms.algorithm import parse_problem
 from pddlstream.algorithms.advanced import enforce_simultaneous, automatically_negate_externals
+from pddlstream.algorithms.allocation import AllocationController
 from pddlstream.algorithms.common import SolutionStore
 from pddlstream.algorithms.constraints import PlanConstraints
 from pddlstream.algorithms.disabled import push_disabled, reenable_disabled, process_stream_plan
 from pddlstream.algorithms.disable_skeleton import create_disabled_axioms
 #from pddlstream.algorithms.downward import has_costs
+from pddlstream.algorithms.downward import DEFAULT_MAX_TIME, SearchHandle
 from pddlstream.algorithms.incremental import process_stream_queue
 from pddlstream.algorithms.instantiation import Instantiator
-from pddlstream.algorithms.refinement import iterative_plan_streams, get_optimistic_solve_fn
+from pddlstream.algorithms.refinement import iterative_plan_streams, get_optimistic_solve_fn, OptimisticLayer, \
+    submit_plan_streams
 from pddlstream.algorithms.scheduling.plan_streams import OptSolution
 from pddlstream.algorithms.reorder import reorder_stream_plan
 from pddlstream.algorithms.skeleton import SkeletonQueue
 from pddlstream.algorithms.visualization import reset_visualizations, create_visualizations, \
     has_pygraphviz, log_plans
 from pddlstream.language.constants import is_plan, get_length, str_from_plan, INFEASIBLE
+from pddlstream.language.external import close_history_logs
 from pddlstream.language.fluent import compile_fluent_streams
 from pddlstream.language.function import Function, Predicate
+from pddlstream.language.object import Object
 from pddlstream.language.optimizer import ComponentStream
 from pddlstream.algorithms.recover_optimizers import combine_optimizers
 from pddlstream.language.statistics import load_stream_statistics, \
     write_stream_statistics, compute_plan_effort
-from pddlstream.language.stream import Stream, StreamResult
-from pddlstream.utils import INF, implies, str_from_object, safe_zip
+from pddlstream.language.stream import Stream, StreamResult, get_dedup_statistics
+from pddlstream.language.temporal import SimplifiedDomain
+from pddlstream.utils import INF, implies, str_from_object, safe_zip, elapsed_time
 
 def get_negative_externals(externals):
     negative_predicates = list(filter(lambda s: type(s) is Predicate, externals)) # and s.is_negative()
@@ -57,15 +67,11 @@ def recover_optimistic_outputs(stream_plan):
             new_mapping.update(safe_zip(new_result.output_objects, opt_result.output_objects))
     return new_stream_plan
 
-def check_dominated(skeleton_queue, stream_plan):
+def check_dominated(skeleton_queue, stream_plan, opt_plan, cost):
     if not is_plan(stream_plan):
         return True
-    for skeleton in skeleton_queue.skeletons:
-        # TODO: has stream_plans and account for different output object values
-        if frozenset(stream_plan) <= frozenset(skeleton.stream_plan):
-            print(stream_plan)
-            print(skeleton.stream_plan)
-    raise NotImplementedError()
+    # TODO: account for different output object values
+    return skeleton_queue.get_dominating(stream_plan, opt_plan, cost) is not None
 
 ##################################################
 
@@ -74,8 +80,8 @@ def solve_abstract(problem, constraints=PlanConstraints(), stream_info={}, repla
                   max_time=INF, max_iterations=INF, max_memory=INF,
                   initial_complexity=0, complexity_step=1, max_complexity=INF,
                   max_skeletons=INF, search_sample_ratio=0, bind=True, max_failures=0,
-                  unit_efforts=False, max_effort=INF, effort_weight=None, reorder=True,
-                  visualize=False, verbose=True, **search_kwargs):
+                  unit_efforts=False, max_effort=INF, effort_weight=None, reorder=True, pipeline=False,
+                  adapt_allocation=False, visualize=False, verbose=True, **search_kwargs):
     """
     Solves a PDDLStream problem by first planning with optimistic stream outputs and then querying streams
     :param problem: a PDDLStream problem
@@ -103,6 +109,8 @@ def solve_abstract(problem, constraints=PlanConstraints(), stream_info={}, repla
     :param max_effort: the maximum amount of stream effort
     :param effort_weight: a multiplier for stream effort compared to action costs
     :param reorder: if True, reorder stream plans to minimize the expected sampling overhead
+    :param pipeline: if True, run the planner for the next optimistic plan in a background thread while the skeleton queue samples
+    :param adapt_allocation: if True, adapt search_sample_ratio and max_planner_time online and persist them per domain
 
     :param visualize: if True, draw the constraint network and stream plan as a graphviz file
     :param verbose: if True, print the result of each stream application
@@ -144,42 +152,108 @@ def solve_abstract(problem, constraints=PlanConstraints(), stream_info={}, repla
     positive_externals = streams + functions + optimizers
     has_optimizers = bool(optimizers) # TODO: deprecate
     assert implies(has_optimizers, use_skeletons)
+    if pipeline and ((ThreadPoolExecutor is None) or not use_skeletons or has_optimizers or negative or
+                     any(stream.is_fluent for stream in streams) or isinstance(domain, SimplifiedDomain)):
+        # TODO: pipeline process_stream_plan and the disabled axioms of optimizers
+        # Planning with negated or fluent streams creates stream instances, which must stay on the main thread
+        # Temporal planners cannot be killed by a SearchHandle
+        pipeline = False
+        print('Warning, pipeline=True requires concurrent.futures, skeletons, and no optimizers, negated streams, '
+              'fluent streams, or temporal actions. Setting pipeline=False')
 
     ################
 
     store = SolutionStore(evaluations, max_time, success_cost, verbose, max_memory=max_memory)
     skeleton_queue = SkeletonQueue(store, domain, disable=not has_optimizers)
+    optimistic_layer = OptimisticLayer() # Reuses optimistic results across iterations
+    executor = ThreadPoolExecutor(max_workers=1) if pipeline else None
+    controller = None
+    if adapt_allocation:
+        controller = AllocationController(search_sample_ratio, search_kwargs.get('max_planner_time', DEFAULT_MAX_TIME),
+                                          pddl_name=externals[0].pddl_name if externals else None, verbose=verbose)
+        controller.load()
+    search_fn = search_future = search_handle = None # The next search, whose planner runs while sampling
     disabled = set() # Max skeletons after a solution
-    while (not store.is_terminated()) and (num_iterations < max_iterations) and (complexity_limit <= max_complexity):
-        num_iterations += 1
+
+    def process_eager():
         eager_instantiator = Instantiator(eager_externals, evaluations) # Only update after an increase?
         if eager_disabled:
             push_disabled(eager_instantiator, disabled)
+        num_calls = 0
         if eager_externals:
-            eager_calls += process_stream_queue(eager_instantiator, store,
-                                                complexity_limit=complexity_limit, verbose=verbose)
-
-        ################
-
-        print('\nIteration: {} | Complexity: {} | Skeletons: {} | Skeleton Queue: {} | Disabled: {} | Evaluations: {} | '
-              'Eager Calls: {} | Cost: {:.3f} | Search Time: {:.3f} | Sample Time: {:.3f} | Total Time: {:.3f}'.format(
-            num_iterations, complexity_limit, len(skeleton_queue.skeletons), len(skeleton_queue), len(disabled),
-            len(evaluations), eager_calls, store.best_cost, store.search_time, store.sample_time, store.elapsed_time()))
+            num_calls += process_stream_queue(eager_instantiator, store,
+                                              complexity_limit=complexity_limit, verbose=verbose)
+        return eager_instantiator, num_calls
+
+    def get_search_fn(handle=None):
+        # Prepared on the main thread, so a pipelined search plans on a snapshot of evaluations
+        # Newly certified facts are merged into the snapshot of the following iteration
+        # If handle, the first planner call runs on the executor and search_fn completes the search after it
+        submit = (handle is not None)
+        planner_kwargs = dict(search_kwargs)
+        if controller is not None:
+            planner_kwargs['max_planner_time'] = controller.max_planner_time
+        if submit:
+            planner_kwargs['handle'] = handle
         optimistic_solve_fn = get_optimistic_solve_fn(goal_exp, domain, negative,
                                                       replan_actions=replan_actions, reachieve=use_skeletons,
                                                       max_cost=min(store.best_cost, constraints.max_cost),
-                                                      max_effort=max_effort, effort_weight=effort_weight, **search_kwargs)
+                                                      max_effort=max_effort, effort_weight=effort_weight, **planner_kwargs)
         # TODO: just set unit effort for each stream beforehand
-        if (max_skeletons is None) or (len(skeleton_queue.skeletons) < max_skeletons):
+        if (max_skeletons is not None) and (max_skeletons <= len(skeleton_queue.skeletons)):
+            return (lambda: (OptSolution(INFEASIBLE, INFEASIBLE, INF), None)), None # TODO: apply elsewhere
+        snapshot = dict(evaluations) if pipeline else evaluations
+        search_complexity = complexity_limit
+        results = exhausted = future = None
+        submit_time = 0.
+        if submit:
+            start_time = time.time()
+            def timed_solve_fn(*args): # Measures the planner call on the executor
+                solve_time = time.time()
+                return optimistic_solve_fn(*args), elapsed_time(solve_time)
+            results, exhausted, future = submit_plan_streams(executor, snapshot, positive_externals,
+                                                             timed_solve_fn, search_complexity,
+                                                             layer=optimistic_layer, max_effort=max_effort)
+            submit_time = elapsed_time(start_time)
+        def search_fn():
+            # Returns the optimistic solution and its search time, which excludes sampling while the planner ran
+            search_time = submit_time
+            first_attempt = None
+            if submit:
+                opt_solution, planner_time = future.result()
+                search_time += planner_time
+                first_attempt = (results, exhausted, opt_solution)
+            start_time = time.time()
             disabled_axioms = create_disabled_axioms(skeleton_queue) if has_optimizers else []
             if disabled_axioms:
                 domain.axioms.extend(disabled_axioms)
-            stream_plan, opt_plan, cost = iterative_plan_streams(evaluations, positive_externals,
-                optimistic_solve_fn, complexity_limit, max_effort=max_effort)
+            opt_solution = iterative_plan_streams(snapshot, positive_externals, optimistic_solve_fn, search_complexity,
+                                                  layer=optimistic_layer, first_attempt=first_attempt,
+                                                  max_effort=max_effort)
             for axiom in disabled_axioms:
                 domain.axioms.remove(axiom)
-        else:
-            stream_plan, opt_plan, cost = OptSolution(INFEASIBLE, INFEASIBLE, INF) # TODO: apply elsewhere
+            return opt_solution, search_time + elapsed_time(start_time)
+        return search_fn, future
+
+    while (not store.is_terminated()) and (num_iterations < max_iterations) and (complexity_limit <= max_complexity):
+        num_iterations += 1
+        if search_fn is None:
+            eager_instantiator, num_calls = process_eager()
+            eager_calls += num_calls
+
+        ################
+
+        print('\nIteration: {} | Complexity: {} | Skeletons: {} | Skeleton Queue: {} | Disabled: {} | Evaluations: {} | '
+              'Eager Calls: {} | Cost: {:.3f} | Search Time: {:.3f} | Sample Time: {:.3f} | Total Time: {:.3f}'.format(
+            num_iterations, complexity_limit, len(skeleton_queue.skeletons), len(skeleton_queue), len(disabled),
+            len(evaluations), eager_calls, store.best_cost, store.search_time, store.sample_time, store.elapsed_time()))
+        if search_fn is None:
+            search_fn, _ = get_search_fn()
+        opt_solution, search_time = search_fn() # Blocks if sampling finished before the planner call
+        stream_plan, opt_plan, cost = opt_solution
+        search_fn = search_future = search_handle = None
+        if (controller is not None) and (search_time is not None):
+            controller.update_search(search_time, is_plan(opt_plan))
 
         ################
 
@@ -226,23 +300,56 @@ def solve_abstract(problem, constraints=PlanConstraints(), stream_info={}, repla
                 get_length(optimizer_plan), compute_plan_effort(optimizer_plan), optimizer_plan))
             skeleton_queue.new_skeleton(optimizer_plan, opt_plan, cost)
 
+        if controller is not None:
+            search_sample_ratio = controller.search_sample_ratio
         allocated_sample_time = (search_sample_ratio * store.search_time) - store.sample_time \
             if len(skeleton_queue.skeletons) <= max_skeletons else INF
+        if pipeline and (not store.is_terminated()) and (num_iterations < max_iterations) and \
+                (complexity_limit <= max_complexity):
+            eager_instantiator, num_calls = process_eager()
+            eager_calls += num_calls
+            search_handle = SearchHandle()
+            search_fn, search_future = get_search_fn(handle=search_handle)
+        start_time = time.time()
+        num_evaluations = len(evaluations)
         if skeleton_queue.process(stream_plan, opt_plan, cost, complexity_limit, allocated_sample_time) is INFEASIBLE:
             break
+        if search_future is not None:
+            skeleton_queue.process_until_done(search_future)
+        if controller is not None:
+            controller.update_sample(elapsed_time(start_time), len(evaluations) - num_evaluations)
 
     ################
 
+    if search_future is not None:
+        # Drops the outstanding search, whose planner would otherwise delay returning the solution
+        search_future.cancel()
+        search_handle.kill()
+    if executor is not None:
+        executor.shutdown(wait=True) # At most waits for the translation or parsing of a killed search
     summary = store.export_summary()
     summary.update({
         'iterations': num_iterations,
         'complexity': complexity_limit,
         'skeletons': len(skeleton_queue.skeletons),
+        'bindings': skeleton_queue.get_num_bindings(),
+        'evicted': skeleton_queue.num_evicted,
+        'equivalent': skeleton_queue.num_equivalent,
+        'dominated': skeleton_queue.num_dominated,
+        'saved_bindings': skeleton_queue.num_saved,
     })
+    summary.update(Object.get_canonical_statistics())
+    summary.update(get_dedup_statistics(externals))
+    if controller is not None:
+        summary.update(controller.export_summary())
     print('Summary: {}'.format(str_from_object(summary, ndigits=3))) # TODO: return the summary
 
     write_stream_statistics(externals, verbose)
-    return store.extract_solution()
+    if controller is not None:
+        controller.write()
+    solution = store.extract_solution()
+    close_history_logs()
+    return solution
 
 solve_focused = solve_abstract # TODO: deprecate solve_focused
 
@@ -2,6 +2,7 @@ from __future__ import print_function
 
 import time
 
+from collections import OrderedDict
 from itertools import product
 from copy import deepcopy, copy
 
@@ -64,6 +65,119 @@ def optimistic_process_streams(evaluations, streams, complexity_limit=INF, **eff
     exhausted = not instantiator
     return results, exhausted
 
+def get_optimistic_state(instance):
+    return instance.opt_index, instance.enumerated, instance.disabled, instance.num_calls
+
+class OptimisticLayer(object):
+    """
+    Maintains the optimistic results of optimistic_process_streams across calls.
+    Only new evaluations and instances whose optimistic state (opt_index, enumerated, disabled, num_calls) changed
+    are processed. The Instantiator cannot retract atoms or change their complexity, which instead requires a reset.
+    All optimistic results are retained per instance, and a result is used if its domain is supported
+    and it certifies a new fact, which reproduces optimistic_process_instance.
+    """
+    def __init__(self):
+        self.streams = None
+        self.instantiator = None
+        self.complexity_from_evaluation = {}
+        self.state_from_instance = {}
+        self.complexity_from_instance = {}
+        self.results_from_instance = OrderedDict()
+        self.certified = set() # Facts certified by the used results
+        self.results = []
+        self.new_results = [] # The delta from the last call
+        self.num_resets = 0
+    def reset(self, streams):
+        self.streams = streams
+        self.instantiator = Instantiator(streams)
+        self.complexity_from_evaluation = {}
+        self.state_from_instance = {}
+        self.complexity_from_instance = {}
+        self.results_from_instance = OrderedDict()
+        self.certified = set()
+        self.results = []
+        self.num_resets += 1
+    def is_consistent(self, evaluations, complexity_limit):
+        for evaluation, complexity in self.complexity_from_evaluation.items():
+            if (evaluation not in evaluations) or (evaluations[evaluation].complexity < complexity) or \
+                    (complexity_limit < complexity):
+                return False
+        return True
+    def get_new_evaluations(self, evaluations, complexity_limit):
+        return OrderedDict((evaluation, node.complexity) for evaluation, node in evaluations.items()
+                           if (node.complexity <= complexity_limit) and
+                           (evaluation not in self.complexity_from_evaluation))
+    def process_instance(self, instance):
+        self.state_from_instance[instance] = get_optimistic_state(instance)
+        complexity = self.instantiator.compute_complexity(instance)
+        self.complexity_from_instance[instance] = complexity
+        results = instance.next_optimistic()
+        for result in results:
+            for fact in result.get_certified():
+                self.instantiator.add_atom(evaluation_from_fact(fact), complexity)
+        self.results_from_instance[instance] = results
+        return results
+    def is_stale(self, instance):
+        # Calling an instance increases its complexity, which might have determined that of its certified atoms
+        previous_complexity = self.complexity_from_instance[instance]
+        if self.instantiator.compute_complexity(instance) <= previous_complexity:
+            return False
+        complexity_from_atom = self.instantiator.complexity_from_atom
+        return any(complexity_from_atom.get(evaluation_from_fact(fact).head) == previous_complexity
+                   for result in self.results_from_instance[instance] for fact in result.get_certified())
+    def is_supported(self, fact):
+        return (fact in self.certified) or (evaluation_from_fact(fact) in self.complexity_from_evaluation)
+    def select_results(self, results):
+        selected = []
+        for result in results:
+            if not all(map(self.is_supported, result.get_domain())):
+                continue
+            if isinstance(result, FunctionResult) or not all(map(self.is_supported, result.get_certified())):
+                self.certified.update(result.get_certified())
+                selected.append(result)
+        return selected
+    def process(self, evaluations, streams, complexity_limit=INF, **effort_args):
+        optimistic_streams = prune_high_effort_streams(streams, **effort_args)
+        if (self.streams != optimistic_streams) or not self.is_consistent(evaluations, complexity_limit):
+            self.reset(optimistic_streams)
+        new_evaluations = self.get_new_evaluations(evaluations, complexity_limit)
+        complexity_from_atom = self.instantiator.complexity_from_atom
+        if any((evaluation.head in complexity_from_atom) and (complexity < complexity_from_atom[evaluation.head])
+               for evaluation, complexity in new_evaluations.items()):
+            # An optimistic atom was previously added with a larger complexity
+            self.reset(optimistic_streams)
+            new_evaluations = self.get_new_evaluations(evaluations, complexity_limit)
+        if any(self.is_stale(instance) for instance in self.results_from_instance
+               if self.state_from_instance[instance] != get_optimistic_state(instance)):
+            # An optimistic atom was previously added with a smaller complexity
+            self.reset(optimistic_streams)
+            new_evaluations = self.get_new_evaluations(evaluations, complexity_limit)
+
+        new_results = []
+        changed = False
+        for instance in list(self.results_from_instance):
+            if self.state_from_instance[instance] != get_optimistic_state(instance):
+                self.process_instance(instance)
+                changed = True
+        for evaluation, complexity in new_evaluations.items():
+            self.complexity_from_evaluation[evaluation] = complexity
+            self.instantiator.add_atom(evaluation, complexity)
+        while self.instantiator and (self.instantiator.min_complexity() <= complexity_limit):
+            new_results.extend(self.process_instance(self.instantiator.pop_stream()))
+        if changed:
+            # Results of changed instances might have supported the domain or certified facts of other results
+            # Instances are processed after their domain atoms are added, so the results are topologically sorted
+            previous_results = set(self.results)
+            self.certified = set()
+            self.results = self.select_results(result for instance_results in self.results_from_instance.values()
+                                               for result in instance_results)
+            self.new_results = [result for result in self.results if result not in previous_results]
+        else:
+            self.new_results = self.select_results(new_results)
+            self.results = self.results + self.new_results
+        exhausted = not self.instantiator
+        return self.results, exhausted
+
 ##################################################
 
 def optimistic_stream_instantiation(instance, bindings, opt_evaluations, only_immediate=False):
@@ -155,10 +269,12 @@ def get_optimistic_solve_fn(goal_exp, domain, negative, max_cost=INF, **kwargs):
 ##################################################
 
 def hierarchical_plan_streams(evaluations, externals, results, optimistic_solve_fn, complexity_limit,
-                              depth, constraints, **effort_args):
+                              depth, constraints, opt_solution=None, **effort_args):
     if MAX_DEPTH <= depth:
         return OptSolution(None, None, INF), depth
-    stream_plan, opt_plan, cost = optimistic_solve_fn(evaluations, results, constraints)
+    if opt_solution is None:
+        opt_solution = optimistic_solve_fn(evaluations, results, constraints)
+    stream_plan, opt_plan, cost = opt_solution
     if not is_plan(opt_plan) or is_refined(stream_plan):
         return OptSolution(stream_plan, opt_plan, cost), depth
     #action_plan, preimage_facts = opt_plan
@@ -190,20 +306,42 @@ def hierarchical_plan_streams(evaluations, externals, results, optimistic_solve_
     return hierarchical_plan_streams(evaluations, externals, next_results, optimistic_solve_fn, complexity_limit,
                                      new_depth, next_constraints, **effort_args)
 
-def iterative_plan_streams(all_evaluations, externals, optimistic_solve_fn, complexity_limit, **effort_args):
+def get_complexity_evaluations(all_evaluations, complexity_limit):
+    return {e: n for e, n in all_evaluations.items() if n.complexity <= complexity_limit}
+
+def submit_plan_streams(executor, all_evaluations, externals, optimistic_solve_fn, complexity_limit, layer,
+                        **effort_args):
+    # Optimistically processes streams on the calling thread, which creates all stream instances and objects
+    # Only the first planner call is submitted to the executor
+    complexity_evals = get_complexity_evaluations(all_evaluations, complexity_limit)
+    results, exhausted = layer.process(complexity_evals, externals, complexity_limit, **effort_args)
+    future = executor.submit(optimistic_solve_fn, complexity_evals, list(results), None)
+    return results, exhausted, future
+
+def iterative_plan_streams(all_evaluations, externals, optimistic_solve_fn, complexity_limit, layer=None,
+                           first_attempt=None, **effort_args):
     # Previously didn't have unique optimistic objects that could be constructed at arbitrary depths
+    # first_attempt is the (results, exhausted, opt_solution) of a planner call from submit_plan_streams
     start_time = time.time()
-    complexity_evals = {e: n for e, n in all_evaluations.items() if n.complexity <= complexity_limit}
+    if layer is None:
+        layer = OptimisticLayer()
+    complexity_evals = get_complexity_evaluations(all_evaluations, complexity_limit)
     num_iterations = 0
     while True:
         num_iterations += 1
-        results, exhausted = optimistic_process_streams(complexity_evals, externals, complexity_limit, **effort_args)
+        opt_solution = None
+        if first_attempt is None:
+            results, exhausted = layer.process(complexity_evals, externals, complexity_limit, **effort_args)
+        else:
+            results, exhausted, opt_solution = first_attempt
+            first_attempt = None
         opt_solution, final_depth = hierarchical_plan_streams(
             complexity_evals, externals, results, optimistic_solve_fn, complexity_limit,
-            depth=0, constraints=None, **effort_args)
+            depth=0, constraints=None, opt_solution=opt_solution, **effort_args)
         stream_plan, action_plan, cost = opt_solution
-        print('Attempt: {} | Results: {} | Depth: {} | Success: {} | Time: {:.3f}'.format(
-            num_iterations, len(results), final_depth, is_plan(action_plan), elapsed_time(start_time)))
+        print('Attempt: {} | Results: {} | New: {} | Resets: {} | Depth: {} | Success: {} | Time: {:.3f}'.format(
+            num_iterations, len(results), len(layer.new_results), layer.num_resets, final_depth,
+            is_plan(action_plan), elapsed_time(start_time)))
         if is_plan(action_plan):
             return OptSolution(stream_plan, action_plan, cost)
         if final_depth == 0:
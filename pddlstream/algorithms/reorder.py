@@ -1,14 +1,30 @@
 import time
 
-from collections import namedtuple, deque, Counter
-from itertools import combinations
+from collections import namedtuple, deque, Counter, OrderedDict
+from heapq import heappush, heappop
+from itertools import combinations, count
 
 from pddlstream.language.constants import is_plan
 from pddlstream.language.external import Result
 from pddlstream.language.statistics import Stats, Performance, EPSILON
 from pddlstream.language.stream import StreamResult
 from pddlstream.utils import INF, neighbors_from_orders, topological_sort, get_connected_components, \
-    sample_topological_sort, is_acyclic, layer_sort, Score, safe_zip
+    sample_topological_sort, layer_sort, Score, safe_zip, elapsed_time, get_mapping
+
+REORDER_SEARCH = 'astar' # astar | dp (exhaustive)
+MAX_REORDER_NODES = 10000 # The maximum number of subsets expanded before greedily completing the best partial order
+MAX_REORDER_TIME = 0.1 # The maximum runtime before greedily completing the best partial order
+MAX_CACHED_ORDERS = 128 # The number of recent stream plans whose partial orders are cached
+
+# Orders between the indices of a stream plan
+# object_descendants[index] is a bitset of the indices reachable from index (inclusive) by following output objects
+StreamPlanOrders = namedtuple('StreamPlanOrders', ['object_orders', 'fact_orders', 'object_successors',
+                                                   'object_descendants'])
+CACHED_ORDERS = OrderedDict()
+
+MAX_CACHED_REORDERS = 1024 # The number of recent stream plan signatures whose reordering is cached
+REORDER_DRIFT = 0.1 # The change in p_success or relative overhead that invalidates a cached reordering
+CACHED_REORDERS = OrderedDict()
 
 
 def get_output_objects(result):
@@ -16,37 +32,84 @@ def get_output_objects(result):
         return result.output_objects
     return tuple()
 
-def get_object_orders(stream_plan):
+def compute_object_index_orders(stream_plan):
+    # Indexes the producers of each output object, which is linear in the total number of arguments
     # TODO: check that only one result per output object
-    partial_orders = set()
-    for i, stream1 in enumerate(stream_plan):
-        for stream2 in stream_plan[i+1:]:
-            if set(get_output_objects(stream1)) & stream2.instance.get_all_input_objects():
-                partial_orders.add((stream1, stream2))
-    return partial_orders
+    producers_from_object = {}
+    index_orders = set()
+    for index2, stream2 in enumerate(stream_plan):
+        for obj in stream2.instance.get_all_input_objects():
+            for index1 in producers_from_object.get(obj, []):
+                index_orders.add((index1, index2))
+        for obj in get_output_objects(stream2):
+            producers_from_object.setdefault(obj, []).append(index2)
+    return index_orders
+
+def compute_fact_index_orders(stream_plan, init_facts=set()):
+    # TODO: explicitly recover this from plan_streams
+    # TODO: init_facts isn't used in practice
+    achieved_facts = set(init_facts)
+    achiever_from_fact = {}
+    index_orders = set()
+    for index2, stream2 in enumerate(stream_plan):
+        for fact in stream2.get_domain():
+            if fact in achiever_from_fact:
+                index_orders.add((achiever_from_fact[fact], index2)) # Prevents circular
+        for fact in stream2.get_certified():
+            if fact not in achieved_facts:
+                achieved_facts.add(fact)
+                achiever_from_fact[fact] = index2
+    return index_orders
+
+def get_stream_plan_orders(stream_plan):
+    # The orders are shared by reordering and each Skeleton that uses the same stream plan
+    key = tuple(stream_plan)
+    if key in CACHED_ORDERS:
+        orders = CACHED_ORDERS.pop(key)
+    else:
+        object_orders = frozenset(compute_object_index_orders(stream_plan))
+        fact_orders = frozenset(compute_fact_index_orders(stream_plan))
+        object_successors = {}
+        for index1, index2 in object_orders:
+            object_successors.setdefault(index1, set()).add(index2)
+        object_descendants = [0]*len(stream_plan)
+        for index1 in reversed(range(len(stream_plan))): # Successors have larger indices
+            object_descendants[index1] = 1 << index1
+            for index2 in object_successors.get(index1, []):
+                object_descendants[index1] |= object_descendants[index2]
+        orders = StreamPlanOrders(object_orders, fact_orders, object_successors, object_descendants)
+    CACHED_ORDERS[key] = orders # Most recently used
+    while MAX_CACHED_ORDERS < len(CACHED_ORDERS):
+        CACHED_ORDERS.popitem(last=False)
+    return orders
+
+def get_index_orders(stream_plan, use_facts=True, init_facts=set()):
+    if init_facts:
+        orders = set(compute_object_index_orders(stream_plan))
+        if use_facts:
+            orders.update(compute_fact_index_orders(stream_plan, init_facts=init_facts))
+        return orders
+    orders = get_stream_plan_orders(stream_plan)
+    if use_facts:
+        return orders.object_orders | orders.fact_orders
+    return set(orders.object_orders)
+
+def get_object_orders(stream_plan):
+    return {(stream_plan[index1], stream_plan[index2])
+            for index1, index2 in get_stream_plan_orders(stream_plan).object_orders}
 
 def get_initial_orders(init_facts, stream_plan):
     return {(fact, stream) for stream in stream_plan for fact in stream.get_domain() if fact in init_facts}
 
 def get_fact_orders(stream_plan, init_facts=set()):
-    # TODO: explicitly recover this from plan_streams
-    # TODO: init_facts isn't used in practice
-    achieved_facts = set(init_facts)
-    partial_orders = set()
-    for i, stream1 in enumerate(stream_plan):
-        new_facts = set(stream1.get_certified()) - achieved_facts
-        for stream2 in stream_plan[i+1:]: # Prevents circular
-            if new_facts & set(stream2.get_domain()):
-                partial_orders.add((stream1, stream2))
-        achieved_facts.update(new_facts)
-    return partial_orders
+    index_orders = compute_fact_index_orders(stream_plan, init_facts=init_facts) if init_facts else \
+        get_stream_plan_orders(stream_plan).fact_orders
+    return {(stream_plan[index1], stream_plan[index2]) for index1, index2 in index_orders}
 
 def get_partial_orders(stream_plan, use_facts=True, **kwargs):
-    partial_orders = get_object_orders(stream_plan)
-    if use_facts:
-        partial_orders.update(get_fact_orders(stream_plan, **kwargs))
-    assert is_acyclic(stream_plan, partial_orders)
-    return partial_orders
+    # Index orders always point forward, so the partial orders are acyclic
+    return {(stream_plan[index1], stream_plan[index2])
+            for index1, index2 in get_index_orders(stream_plan, use_facts=use_facts, **kwargs)}
 
 ##################################################
 
@@ -159,6 +222,115 @@ def dynamic_programming(store, vertices, valid_head_fn, stats_fn=Performance.get
     #    len(ordering), compute_expected_cost(ordering, stats_fn=stats_fn), elapsed_time(start_time)))
     return ordering
 
+def get_cost_ratio(stats):
+    # Without partial orders, sorting by this ratio minimizes the expected cost
+    p_success, overhead = stats
+    if p_success < 1:
+        return overhead / (1. - p_success)
+    return INF
+
+def bounded_search(store, vertices, orders, stats_fn=Performance.get_statistics,
+                   max_nodes=MAX_REORDER_NODES, max_time=MAX_REORDER_TIME, verbose=False):
+    """
+    A* over the subsets of vertices that form a prefix of the ordering.
+    A prefix's success probability is independent of its order, so the cheapest ordering of each subset dominates.
+    The heuristic is the expected cost of the remaining vertices sorted by cost ratio while ignoring orders,
+    which is admissible and consistent.
+    Adjacent unordered vertices are only expanded in cost ratio order, which preserves an optimal ordering.
+    If the budget is exhausted, the best partial order is completed greedily (anytime).
+
+    :param store: a SolutionStore that can terminate the search
+    :param vertices: a list of vertices
+    :param orders: a set of partial orders (v1, v2) where v1 must precede v2
+    :param stats_fn: a function from a vertex to its Stats
+    :param max_nodes: the maximum number of expanded subsets
+    :param max_time: the maximum runtime
+    :param verbose: if True, print the search statistics
+    :return: an ordering of the vertices
+    """
+    start_time = time.time()
+    vertices = list(vertices)
+    num = len(vertices)
+    index_from_vertex = {v: i for i, v in enumerate(vertices)}
+    predecessors = [0]*num # Bitmasks
+    for v1, v2 in orders:
+        predecessors[index_from_vertex[v2]] |= 1 << index_from_vertex[v1]
+    p_successes, overheads = zip(*map(stats_fn, vertices)) if vertices else ((), ())
+    ratio_order = sorted(range(num), key=lambda i: get_cost_ratio(stats_fn(vertices[i])))
+    rank = {i: r for r, i in enumerate(ratio_order)}
+    full_subset = (1 << num) - 1
+
+    def heuristic(subset):
+        cost, p_success = 0., 1.
+        for i in ratio_order:
+            if not (subset >> i) & 1:
+                cost += p_success*overheads[i]
+                p_success *= p_successes[i]
+        return cost
+
+    def complete(subset, ordering, cost, p_success):
+        ordering = list(ordering)
+        while subset != full_subset:
+            i = next(i for i in ratio_order if not ((subset >> i) & 1) and not (predecessors[i] & ~subset))
+            ordering.append(i)
+            cost += p_success*overheads[i]
+            p_success *= p_successes[i]
+            subset |= 1 << i
+        return cost, ordering
+
+    def recover(subset):
+        ordering = []
+        while parents[subset] is not None:
+            subset, i = parents[subset]
+            ordering.append(i)
+        return ordering[::-1]
+
+    best_cost, best_ordering = complete(0, [], 0., 1.)
+    costs = {0: 0.}
+    parents = {0: None}
+    counter = count()
+    queue = [(heuristic(0), 0, next(counter), 0., 1., 0)]
+    num_expanded = 0
+    optimal = False
+    while queue:
+        if store.is_terminated() or (max_nodes <= num_expanded) or (max_time <= elapsed_time(start_time)):
+            break
+        f, depth, _, cost, p_success, subset = heappop(queue)
+        if costs[subset] < cost:
+            continue
+        if best_cost <= f:
+            optimal = True
+            break
+        if subset == full_subset:
+            best_cost, best_ordering = cost, recover(subset)
+            optimal = True
+            break
+        num_expanded += 1
+        last = parents[subset][1] if parents[subset] is not None else None
+        for i in range(num):
+            if ((subset >> i) & 1) or (predecessors[i] & ~subset):
+                continue
+            if (last is not None) and not ((predecessors[i] >> last) & 1) and (rank[i] < rank[last]):
+                # Swapping an adjacent unordered pair into ratio order never increases the cost
+                continue
+            new_subset = subset | (1 << i)
+            new_cost = cost + p_success*overheads[i]
+            if new_cost < costs.get(new_subset, INF):
+                costs[new_subset] = new_cost
+                parents[new_subset] = (subset, i)
+                new_p_success = p_success*p_successes[i]
+                new_f = new_cost + new_p_success*heuristic(new_subset)
+                heappush(queue, (new_f, depth - 1, next(counter), new_cost, new_p_success, new_subset)) # Deepest first
+    if not optimal and queue:
+        _, _, _, cost, p_success, subset = queue[0]
+        cost, ordering = complete(subset, recover(subset), cost, p_success)
+        if cost < best_cost:
+            best_cost, best_ordering = cost, ordering
+    if verbose:
+        print('Vertices: {} | Expanded: {} | Optimal: {} | Expected cost: {:.3f} | Time: {:.3f}'.format(
+            num, num_expanded, optimal, best_cost, elapsed_time(start_time)))
+    return [vertices[i] for i in best_ordering]
+
 ##################################################
 
 def dummy_reorder_stream_plan(stream_plan, **kwargs):
@@ -234,7 +406,7 @@ def compute_statistics(stream_plan, bias=True):
 
 ##################################################
 
-def optimal_reorder_stream_plan(store, stream_plan, stats_from_stream=None, **kwargs):
+def optimal_reorder_stream_plan(store, stream_plan, stats_from_stream=None, search=REORDER_SEARCH, **kwargs):
     if not stream_plan:
         return stream_plan
     if stats_from_stream is None:
@@ -258,6 +430,9 @@ def optimal_reorder_stream_plan(store, stream_plan, stats_from_stream=None, **kw
     #print(dijkstra(sources, get_partial_orders(stream_plan)))
 
     stats_fn = lambda idx: stats_from_stream[stream_plan[idx]]
+    if search == 'astar':
+        ordering = bounded_search(store, nodes, stream_orders, stats_fn=stats_fn, **kwargs)
+        return [stream_plan[index] for index in ordering]
     #tiebreaker_fn = lambda *args: 0
     #tiebreaker_fn = lambda *args: random.random() # TODO: introduces cycles
     tiebreaker_fn = lambda idx: stream_plan[idx].stats_heuristic()
@@ -268,10 +443,40 @@ def optimal_reorder_stream_plan(store, stream_plan, stats_from_stream=None, **kw
 
 ##################################################
 
+def get_plan_signature(stream_plan):
+    # The externals and dataflow of a stream plan, which are shared across iterations and problems
+    return (tuple(result.external.name for result in stream_plan), frozenset(get_index_orders(stream_plan)))
+
+def has_drifted(old_stats, new_stats, threshold=REORDER_DRIFT):
+    for (p_success1, overhead1), (p_success2, overhead2) in safe_zip(old_stats, new_stats):
+        if (threshold < abs(p_success1 - p_success2)) or \
+                (threshold*max(overhead1, EPSILON) < abs(overhead1 - overhead2)):
+            return True
+    return False
+
 def reorder_stream_plan(store, stream_plan, algorithm=None, **kwargs):
     if not stream_plan:
         return stream_plan
-
+    if (algorithm == 'random') or kwargs:
+        return compute_reordering(store, stream_plan, algorithm=algorithm, **kwargs)
+    # Memoizes the ordering of indices until the statistics drift from those it was computed with
+    key = (algorithm, get_plan_signature(stream_plan))
+    stats = [result.external.get_statistics() for result in stream_plan]
+    if key in CACHED_REORDERS:
+        old_stats, ordering = CACHED_REORDERS.pop(key)
+        if not has_drifted(old_stats, stats):
+            CACHED_REORDERS[key] = (old_stats, ordering) # Most recently used
+            return [stream_plan[index] for index in ordering]
+    new_plan = compute_reordering(store, stream_plan, algorithm=algorithm)
+    if store.is_terminated():
+        return new_plan # The search might have been interrupted
+    index_from_result = get_mapping(stream_plan, range(len(stream_plan)))
+    CACHED_REORDERS[key] = (stats, [index_from_result[result] for result in new_plan])
+    while MAX_CACHED_REORDERS < len(CACHED_REORDERS):
+        CACHED_REORDERS.popitem(last=False)
+    return new_plan
+
+def compute_reordering(store, stream_plan, algorithm=None, **kwargs):
     stats_from_stream = compute_statistics(stream_plan)
     stats = Counter(stats_from_stream.values())
     if algorithm is None:
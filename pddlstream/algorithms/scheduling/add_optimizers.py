@@ -1,6 +1,6 @@
 from pddlstream.algorithms.downward import fd_from_fact, fact_from_fd
 from pddlstream.algorithms.scheduling.negative import get_negative_result
-from pddlstream.algorithms.scheduling.recover_streams import extract_stream_plan
+from pddlstream.algorithms.scheduling.recover_streams import StreamPlanExtractor
 from pddlstream.algorithms.scheduling.utils import get_instance_facts
 from pddlstream.language.optimizer import ComponentStream
 from pddlstream.language.constants import get_args, get_prefix
@@ -14,6 +14,7 @@ def add_optimizer_effects(instantiated, node_from_atom):
     # TODO: instantiate axioms with negative on effects for blocking
     # TODO: fluent streams using conditional effects. Special fluent predicate for inputs to constraint
     # TODO: bug! The FD instantiator prunes the result.external.stream_fact
+    extractor = StreamPlanExtractor(node_from_atom)
     for instance in instantiated.actions:
         # TODO: need to handle case where a negative preconditions is used in an optimizer
         for condition, effect in (instance.add_effects + instance.del_effects):
@@ -22,8 +23,7 @@ def add_optimizer_effects(instantiated, node_from_atom):
                 if (fact in node_from_atom) and (node_from_atom[fact].result is not None):
                     raise NotImplementedError(literal)
         facts = get_instance_facts(instance, node_from_atom)
-        stream_plan = []
-        extract_stream_plan(node_from_atom, facts, stream_plan)
+        stream_plan = extractor.extract(facts)
         # TODO: can detect if some of these are simultaneous and add them as preconditions
         for result in stream_plan:
             #if isinstance(result.external, ComponentStream):
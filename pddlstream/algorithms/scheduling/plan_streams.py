@@ -16,7 +16,7 @@ from pddlstream.algorithms.scheduling.postprocess import postprocess_stream_plan
 from pddlstream.algorithms.scheduling.recover_axioms import recover_axioms_plans
 from pddlstream.algorithms.scheduling.recover_functions import compute_function_plan
 from pddlstream.algorithms.scheduling.recover_streams import get_achieving_streams, extract_stream_plan, \
-    evaluations_from_stream_plan
+    evaluations_from_stream_plan, StreamPlanExtractor
 from pddlstream.algorithms.scheduling.stream_action import add_stream_actions
 from pddlstream.algorithms.scheduling.utils import partition_results, \
     add_unsatisfiable_to_goal, get_instance_facts
@@ -30,7 +30,6 @@ from pddlstream.language.exogenous import get_fluent_domain
 from pddlstream.language.function import Function
 from pddlstream.language.stream import StreamResult
 from pddlstream.language.optimizer import UNSATISFIABLE
-from pddlstream.language.statistics import compute_plan_effort
 from pddlstream.language.temporal import SimplifiedDomain, solve_tfd
 from pddlstream.language.write_pddl import get_problem_pddl
 from pddlstream.language.object import Object
@@ -50,14 +49,13 @@ def add_stream_efforts(node_from_atom, instantiated, effort_weight, **kwargs):
     # TODO: make effort just a multiplier (or relative) to avoid worrying about the scale
     # TODO: regularize & normalize across the problem?
     #efforts = []
+    extractor = StreamPlanExtractor(node_from_atom, **kwargs) # Many actions share preconditions
     for instance in instantiated.actions:
         # TODO: prune stream actions here?
         # TODO: round each effort individually to penalize multiple streams
         facts = get_instance_facts(instance, node_from_atom)
         #effort = COMBINE_OP([0] + [node_from_atom[fact].effort for fact in facts])
-        stream_plan = []
-        extract_stream_plan(node_from_atom, facts, stream_plan)
-        effort = compute_plan_effort(stream_plan, **kwargs)
+        effort = extractor.get_effort(facts)
         instance.cost += scale_cost(effort_weight*effort)
         # TODO: store whether it uses shared/unique outputs and prune too expensive streams
         #efforts.append(effort)
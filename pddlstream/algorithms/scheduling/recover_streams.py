@@ -58,19 +58,67 @@ def evaluations_from_stream_plan(evaluations, stream_results, max_effort=INF):
                               if check_effort(n.effort, max_effort)}
     return result_from_evaluation
 
+class StreamPlanExtractor(object):
+    """
+    Memoizes the results that transitively achieve each atom within node_from_atom.
+    A single extractor is shared across the actions of a planning call, so each atom's subtree is only visited once.
+    """
+    def __init__(self, node_from_atom, **effort_args):
+        self.node_from_atom = node_from_atom
+        self.effort_args = effort_args
+        self.plan_from_atom = {} # Results in the order that extract_stream_plan appends them
+        self.results_from_atom = {}
+        self.effort_from_result = {}
+        self.effort_from_facts = {}
+    def get_plan(self, fact):
+        # Dependencies precede each result (i.e. postorder)
+        if fact not in self.plan_from_atom:
+            if fact not in self.node_from_atom:
+                raise RuntimeError('Preimage fact {} is not achievable!'.format(fact))
+                #RuntimeError: Preimage fact ('new-axiom@0',) is not achievable!
+            result = self.node_from_atom[fact].result
+            if result is None:
+                plan = tuple()
+            else:
+                plan = self.extract(result.instance.get_domain()) + (result,)
+            self.plan_from_atom[fact] = plan
+        return self.plan_from_atom[fact]
+    def get_results(self, facts):
+        # TODO: bitsets if unions of large sets are a bottleneck
+        results = set()
+        for fact in facts:
+            if fact not in self.results_from_atom:
+                self.results_from_atom[fact] = frozenset(self.get_plan(fact))
+            results.update(self.results_from_atom[fact])
+        return results
+    def extract(self, target_facts, stream_plan=tuple()):
+        # Appends to a copy of stream_plan the results that are not already within it
+        new_plan = list(stream_plan)
+        extracted = set(new_plan)
+        for fact in target_facts:
+            for result in self.get_plan(fact):
+                if result not in extracted:
+                    extracted.add(result)
+                    new_plan.append(result)
+        return tuple(new_plan)
+    def get_result_effort(self, result):
+        if result not in self.effort_from_result:
+            self.effort_from_result[result] = result.get_effort(**self.effort_args)
+        return self.effort_from_result[result]
+    def get_effort(self, target_facts):
+        # Equivalent to compute_plan_effort of the extracted stream plan
+        key = frozenset(target_facts)
+        if key not in self.effort_from_facts:
+            self.effort_from_facts[key] = sum(map(self.get_result_effort, self.get_results(key)))
+        return self.effort_from_facts[key]
+    def extract_all(self, facts_list):
+        return [list(self.extract(target_facts)) for target_facts in facts_list]
+    def get_efforts(self, facts_list):
+        return [self.get_effort(target_facts) for target_facts in facts_list]
+
 def extract_stream_plan(node_from_atom, target_facts, stream_plan):
     # TODO: prune with rules
     # TODO: linearization that takes into account satisfied goals at each level
-    # TODO: can optimize for all streams & axioms all at once
-    for fact in target_facts:
-        if fact not in node_from_atom:
-            raise RuntimeError('Preimage fact {} is not achievable!'.format(fact))
-            #RuntimeError: Preimage fact ('new-axiom@0',) is not achievable!
-        result = node_from_atom[fact].result
-        if result is None:
-            continue
-        extract_stream_plan(node_from_atom, result.instance.get_domain(), stream_plan)
-        if result not in stream_plan:
-            # TODO: dynamic programming version that doesn't reconsider facts
-            # TODO: don't add if the fact is already satisfied
-            stream_plan.append(result)
+    # TODO: don't add if the fact is already satisfied
+    # Use a StreamPlanExtractor directly to share its memoization across calls
+    stream_plan[:] = StreamPlanExtractor(node_from_atom).extract(target_facts, stream_plan)
@@ -1,23 +1,26 @@
 from __future__ import print_function
 
 import time
-from collections import namedtuple
+from collections import namedtuple, defaultdict, OrderedDict
 try:
     from collections import Sized
 except ImportError:
     from collections.abc import Sized
 from itertools import count
-from heapq import heappush, heappop
+from heapq import heappush, heappop, heapify
 
 from pddlstream.algorithms.common import is_instance_ready, compute_complexity, stream_plan_complexity, add_certified, \
     stream_plan_preimage, COMPLEXITY_OP
-from pddlstream.language.conversion import evaluation_from_fact
+from pddlstream.language.conversion import evaluation_from_fact, transform_action_args, replace_expression
 from pddlstream.algorithms.disabled import process_instance, update_bindings, update_cost, bind_action_plan
-from pddlstream.algorithms.reorder import get_output_objects, get_object_orders, get_partial_orders, get_initial_orders
-from pddlstream.language.constants import is_plan, INFEASIBLE, FAILED, SUCCEEDED
+from pddlstream.algorithms.reorder import get_stream_plan_orders, get_index_orders
+from pddlstream.language.constants import is_plan, get_args, INFEASIBLE, FAILED, SUCCEEDED
+from pddlstream.language.external import retains_history
 from pddlstream.language.function import FunctionResult
+from pddlstream.language.object import OptimisticObject
 from pddlstream.algorithms.visualization import visualize_stream_orders
-from pddlstream.utils import elapsed_time, HeapElement, apply_mapping, INF, get_mapping, adjacent_from_edges, \
+from pddlstream.language.statistics import THOMPSON
+from pddlstream.utils import elapsed_time, AddressableHeap, apply_mapping, INF, adjacent_from_edges, \
     incoming_from_edges, outgoing_from_edges
 
 # TODO: the bias away from solved things is actually due to USE_PRIORITIES+timed_process not REQUIRE_DOWNSTREAM
@@ -25,25 +28,92 @@ USE_PRIORITIES = True
 GREEDY_VISITS = 0
 GREEDY_BEST = True
 REQUIRE_DOWNSTREAM = True
+SUCCESS_PRIORITY = None # None | MEAN | THOMPSON (deprioritizes bindings whose instance is unlikely to succeed)
+MAX_IN_FLIGHT = 1 # The number of top bindings whose next stream call is evaluated concurrently
+PRUNE_BINDINGS = False # Collapses exhausted and dominated subtrees into summaries of their leaves
+MAX_BINDINGS = INF # The number of retained bindings before the lowest priority skeletons are evicted
 
 Priority = namedtuple('Priority', ['not_greedy', 'complexity', 'visits', 'remaining', 'cost']) # TODO: FIFO
-Affected = namedtuple('Affected', ['indices', 'has_cost'])
-
-def compute_affected_downstream(stream_plan, index):
+class Affected(namedtuple('Affected', ['descendants', 'has_cost'])):
+    # descendants is a bitset of stream plan indices, which supports constant-time membership queries
+    def __contains__(self, index):
+        return bool((self.descendants >> index) & 1)
+    @property
+    def indices(self):
+        return [index for index in range(self.descendants.bit_length()) if index in self]
+CanonicalObject = namedtuple('CanonicalObject', ['index'])
+SkeletonKey = namedtuple('SkeletonKey', ['actions', 'streams'])
+
+def get_stream_args(stream_action):
+    return tuple(stream_action.inputs) + tuple(stream_action.outputs)
+
+def get_skeleton_key(stream_plan, action_plan):
+    # Renames optimistic objects in order of first appearance within the action plan
+    # The remaining optimistic objects are ordered by color refinement over the streams that mention them,
+    # so isomorphic stream plans that are ordered differently receive the same key
+    mapping = {}
+    def fn(obj):
+        if not isinstance(obj, OptimisticObject):
+            return obj
+        if obj not in mapping:
+            mapping[obj] = CanonicalObject(len(mapping))
+        return mapping[obj]
+    actions = tuple(transform_action_args(action, fn) for action in action_plan.action_plan)
+    stream_actions = [result.get_action() for result in stream_plan]
+    incidence = OrderedDict() # Unnamed objects in order of first appearance
+    for stream_action in stream_actions:
+        for obj in get_stream_args(stream_action):
+            if isinstance(obj, OptimisticObject) and (obj not in mapping):
+                incidence.setdefault(obj, []).append(stream_action)
+    color_from_obj = {obj: 0 for obj in incidence}
+    def get_color(obj):
+        if obj in mapping:
+            return ('named', mapping[obj].index)
+        if obj in color_from_obj:
+            return ('unnamed', color_from_obj[obj])
+        return ('constant', str(obj))
+    for _ in range(len(stream_actions)):
+        signatures = {}
+        for obj, obj_actions in incidence.items():
+            signatures[obj] = (color_from_obj[obj], sorted(
+                (stream_action.name, get_stream_args(stream_action).index(obj),
+                 tuple(map(get_color, get_stream_args(stream_action)))) for stream_action in obj_actions))
+        ranks = {signature: rank for rank, signature in enumerate(sorted(set(map(str, signatures.values()))))}
+        num_colors = len(set(color_from_obj.values()))
+        color_from_obj = {obj: ranks[str(signature)] for obj, signature in signatures.items()}
+        if len(ranks) == num_colors:
+            break
+    for obj in sorted(incidence, key=color_from_obj.get): # Stable for objects with equal colors
+        fn(obj)
+    streams = []
+    for result, stream_action in zip(stream_plan, stream_actions):
+        fluent_facts = frozenset(replace_expression(fact, lambda o: mapping.get(o, o))
+                                 for fact in getattr(result.instance, 'fluent_facts', []))
+        streams.append((transform_action_args(stream_action, fn), fluent_facts))
+    return SkeletonKey(actions, tuple(sorted(streams, key=str)))
+
+def get_anchored_streams(key):
+    # Streams whose objects are all named by the action plan or constants, which are named consistently across keys
+    # Stream-only objects are named by color refinement ranks, which differ between a plan and its subsets
+    action_objects = {obj for action in key.actions for obj in action[1] if isinstance(obj, CanonicalObject)}
+    anchored = set()
+    for stream_action, fluent_facts in key.streams:
+        objects = set(get_stream_args(stream_action)) | {obj for fact in fluent_facts for obj in get_args(fact)}
+        if all((obj in action_objects) or not isinstance(obj, CanonicalObject) for obj in objects):
+            anchored.add((stream_action, fluent_facts))
+    return anchored
+
+def get_cost_bitset(stream_plan):
+    return sum(1 << index for index, result in enumerate(stream_plan) if type(result) is FunctionResult)
+
+def compute_affected_downstream(stream_plan, index, cost_bitset=None):
     # TODO: if the cost is pruned, then add everything that contributes, not just the last function
-    affected_indices = [index]
-    result = stream_plan[index]
-    has_cost = (type(result) is FunctionResult)
-    output_objects = set(get_output_objects(result))
-    if not output_objects: # TODO: should I do conditions instead?
-        return Affected(affected_indices, has_cost)
-    for index2 in range(index + 1, len(stream_plan)):
-        result2 = stream_plan[index2]
-        if output_objects & result2.instance.get_all_input_objects(): # TODO: get_object_orders
-            output_objects.update(get_output_objects(result2)) # TODO: just include directly affected?
-            affected_indices.append(index2)
-            has_cost |= (type(result2) is FunctionResult)
-    return Affected(affected_indices, has_cost)
+    # The descendants of index when following output objects
+    # TODO: just include directly affected?
+    if cost_bitset is None:
+        cost_bitset = get_cost_bitset(stream_plan)
+    descendants = get_stream_plan_orders(stream_plan).object_descendants[index]
+    return Affected(descendants, has_cost=bool(descendants & cost_bitset))
 
 def compute_affected_component(stream_plan, index):
     # TODO: affected upstream
@@ -55,30 +125,44 @@ class Skeleton(object):
     def __init__(self, queue, stream_plan, action_plan, cost):
         # TODO: estimate statistics per stream_instance online and use to reorder the skeleton
         self.queue = queue
-        self.index = len(self.queue.skeletons)
+        self.index = len(self.queue.skeletons) + self.queue.num_evicted
+        self.key = get_skeleton_key(stream_plan, action_plan)
         self.stream_plan = stream_plan
         self.action_plan = action_plan
         self.cost = cost
         self.best_binding = None
         self.improved = False
+        self.version = 0 # Incremented when the preimage complexities change, which invalidates cached complexities
+        self.num_bindings = 0 # The number of bindings within the tree (excluding pruned bindings)
+        self.num_created = 0 # The number of bindings ever created
+        self.num_queued = 0 # The number of bindings within the queue or standby
         self.root = Binding(self, self.cost, history=[], mapping={}, index=0, parent=None, parent_result=None)
-        self.affected_indices = [compute_affected_downstream(self.stream_plan, index)
+        cost_bitset = get_cost_bitset(self.stream_plan)
+        self.affected_indices = [compute_affected_downstream(self.stream_plan, index, cost_bitset=cost_bitset)
                                  for index in range(len(self.stream_plan))]
 
-        stream_orders = get_partial_orders(self.stream_plan) # init_facts=self.queue.evaluations)
-        index_from_result = get_mapping(stream_plan, range(len(stream_plan)))
-        index_orders = {(index_from_result[r1], index_from_result[r2]) for r1, r2 in stream_orders}
+        index_orders = get_index_orders(self.stream_plan) # init_facts=self.queue.evaluations)
 
         preimage = stream_plan_preimage(stream_plan)
-        self.preimage_complexities = [[queue.evaluations[evaluation_from_fact(fact)].complexity
-                                       for fact in stream.get_domain() if fact in preimage] for stream in stream_plan]
+        self.preimage_evaluations = [[evaluation_from_fact(fact) for fact in stream.get_domain() if fact in preimage]
+                                     for stream in stream_plan]
+        self.preimage_complexities = self.compute_preimage_complexities()
         self.incoming_indices = incoming_from_edges(index_orders)
         self.outgoing_indices = outgoing_from_edges(index_orders)
 
         #min_complexity = stream_plan_complexity(self.queue.evaluations, self.stream_plan, [0]*len(stream_plan))
-        # TODO: compute this all at once via hashing
+    def compute_preimage_complexities(self):
+        return [[self.queue.evaluations[evaluation].complexity for evaluation in evaluations]
+                for evaluations in self.preimage_evaluations]
+    def update_preimage_complexities(self):
+        # Called after evaluations are re-added with a lower complexity
+        preimage_complexities = self.compute_preimage_complexities()
+        if preimage_complexities == self.preimage_complexities:
+            return False
+        self.preimage_complexities = preimage_complexities
+        self.version += 1
+        return True
     def compute_complexity(self, stream_calls, complexities=[]):
-        # TODO: use the previous value when possible
         assert len(stream_calls) == len(self.stream_plan)
         start_index = len(complexities)
         complexities = complexities + [0]*(len(stream_calls) - start_index)
@@ -90,6 +174,28 @@ class Skeleton(object):
         domain_complexity = COMPLEXITY_OP([0] + self.preimage_complexities[index] +
                                           [complexities[index2] for index2 in self.incoming_indices[index]])
         return domain_complexity + self.stream_plan[index].external.get_complexity(num_calls=num_calls)
+    def propagate_complexity(self, complexities, index, num_calls):
+        # Updates the complexity of index given num_calls and then of its descendants (which have zero calls)
+        # Only descendants whose complexity changes are visited, and complexities is copied upon the first change
+        complexity = self.compute_index_complexity(index, num_calls, complexities)
+        if complexity == complexities[index]:
+            return complexities
+        complexities = list(complexities)
+        complexities[index] = complexity
+        queue = list(self.outgoing_indices[index])
+        heapify(queue) # Increasing indices are a topological order
+        visited = set()
+        while queue:
+            index2 = heappop(queue)
+            if index2 in visited:
+                continue
+            visited.add(index2)
+            complexity = self.compute_index_complexity(index2, 0, complexities)
+            if complexity != complexities[index2]:
+                complexities[index2] = complexity
+                for index3 in self.outgoing_indices[index2]:
+                    heappush(queue, index3)
+        return complexities
     def update_best(self, binding):
         if (self.best_binding is None) or (self.best_binding.index < binding.index) or \
                 ((self.best_binding.index == binding.index) and (binding.cost < self.best_binding.cost)):
@@ -131,7 +237,12 @@ class Binding(object):
         self.calls = 0 # The index for result_history
         self.complexity = None
         self.complexities = None
+        self.complexity_key = None # The (skeleton version, calls) used to compute complexities
+        self.exhausted = False # No further descendants will be created
+        self.summary = None # The leaves of a pruned subtree: {index: (min_cost, max_cost)}
         self.max_history = max(self.history) if self.history else 0
+        self.skeleton.num_bindings += 1
+        self.skeleton.num_created += 1
         self.skeleton.update_best(self)
         self.num = next(self.counter) # TODO: FIFO
     @property
@@ -151,7 +262,56 @@ class Binding(object):
     def is_enumerated(self):
         return self.is_fully_bound or self.result.enumerated
     def is_unsatisfied(self):
-        return not self.children
+        return not self.children and (self.summary is None)
+    def is_exhausted(self):
+        # Dominance is permanent because costs only increase down the tree
+        if self.is_fully_bound or self.is_dominated():
+            return True
+        return self.is_enumerated() and self.up_to_date() and all(child.exhausted for child in self.children)
+    def update_exhausted(self):
+        if self.exhausted or not self.is_exhausted():
+            return False
+        self.exhausted = True
+        if PRUNE_BINDINGS:
+            self.prune()
+        if self.parent is not None:
+            self.parent.update_exhausted()
+        return True
+    def get_summary(self):
+        if self.summary is not None:
+            return self.summary
+        if not self.children:
+            return {self.index: (self.cost, self.cost)}
+        summary = {}
+        for child in self.children:
+            for index, (min_cost, max_cost) in child.get_summary().items():
+                if index in summary:
+                    min_cost = min(min_cost, summary[index][0])
+                    max_cost = max(max_cost, summary[index][1])
+                summary[index] = (min_cost, max_cost)
+        return summary
+    def prune(self):
+        # Collapses the descendants into a summary that is sufficient for check_downstream
+        # Pruned bindings that remain within the queue are still processed
+        if not self.children:
+            return 0
+        self.summary = self.get_summary()
+        descendants = list(self.post_order())[:-1]
+        for binding in descendants:
+            binding.exhausted = True # Prevents pruning a detached binding again
+        num_pruned = len(descendants)
+        self.children = []
+        self.skeleton.num_bindings -= num_pruned
+        return num_pruned
+    def check_summary(self, affected):
+        # Equivalent to check_downstream_helper on the pruned subtree
+        best_cost = self.skeleton.queue.store.best_cost
+        for index, (min_cost, max_cost) in self.summary.items():
+            if (best_cost <= max_cost) and affected.has_cost:
+                return True
+            if (min_cost < best_cost) and (index in affected):
+                return True
+        return False
     def is_greedy(self):
         return (self.visits <= GREEDY_VISITS) and (not GREEDY_BEST or self.is_best())
     def up_to_date(self):
@@ -165,17 +325,20 @@ class Binding(object):
         if self.is_fully_bound:
             return 0
         # TODO: use last if self.result.external.get_complexity(num_calls=INF) == 0
-        # TODO: intelligently compute/cache this - store parent stream_plan_complexity or compute formula per skeleton
-        if self.complexity is None:
-            full_history = self.history + [self.calls] # TODO: relevant history, full history, or future
-            future = full_history + [0]*(len(self.skeleton.stream_plan) - len(full_history))
-            parent_complexities = [0]*len(self.skeleton.stream_plan) if self.index == 0 else self.parent.complexities
-            if self.skeleton.outgoing_indices[self.index]:
-                self.complexities = self.skeleton.compute_complexity(future, complexities=parent_complexities[:self.index])
+        key = (self.skeleton.version, self.calls)
+        if self.complexity_key != key:
+            # Incrementally updates the complexities of the parent (or this binding's previous complexities)
+            if (self.complexity_key is not None) and (self.complexity_key[0] == self.skeleton.version):
+                complexities = self.complexities # Only the calls at this index changed
+            elif self.parent is None:
+                complexities = self.skeleton.compute_complexity([0]*len(self.skeleton.stream_plan))
             else:
-                self.complexities = list(parent_complexities)
-                self.complexities[self.index] = self.skeleton.compute_index_complexity(self.index, self.calls, self.complexities)
+                self.parent.compute_complexity()
+                complexities = self.skeleton.propagate_complexity(
+                    self.parent.complexities, self.parent.index, self.history[-1])
+            self.complexities = self.skeleton.propagate_complexity(complexities, self.index, self.calls)
             self.complexity = COMPLEXITY_OP(self.complexities)
+            self.complexity_key = key
             #self.complexity = stream_plan_complexity(self.skeleton.queue.evaluations, self.skeleton.stream_plan, future)
         return self.complexity
         #return compute_complexity(self.skeleton.queue.evaluations, self.result.get_domain()) + \
@@ -191,8 +354,10 @@ class Binding(object):
         if self.is_dominated():
             # Keep exploring down branches that contain a cost term
             return affected.has_cost
+        if self.summary is not None:
+            return self.check_summary(affected)
         if self.is_unsatisfied(): # or type(self.result) == FunctionResult): # not self.visits
-            return self.index in affected.indices
+            return self.index in affected
         # TODO: only prune functions here if the reset of the plan is feasible
         #if not affected.indices or (max(affected.indices) < self.index):
         #    # Cut branch for efficiency purposes
@@ -210,6 +375,10 @@ class Binding(object):
         #priority = self.visits
         #priority = self.compute_complexity()
         priority = self.compute_complexity() + (self.visits - self.calls) # TODO: check this
+        if (SUCCESS_PRIORITY is not None) and not self.is_fully_bound:
+            # Expected number of failed calls before the next success
+            p_success = self.result.instance.get_p_success(sample=(SUCCESS_PRIORITY == THOMPSON))
+            priority += (1. - p_success) / p_success
         # TODO: call_index
         remaining = len(self.skeleton.stream_plan) - self.index
         return Priority(not self.is_greedy(), priority, self.visits, remaining, self.cost)
@@ -248,7 +417,6 @@ class Binding(object):
                         parent_result=new_result))
         self.calls = instance.num_calls
         self.visits = max(self.visits, self.calls)
-        self.complexity = None # Forces re-computation
         #self.skeleton.visualize_bindings()
         return new_bindings
     def __repr__(self):
@@ -259,14 +427,23 @@ class Binding(object):
 STANDBY = None
 
 class SkeletonQueue(Sized):
-    def __init__(self, store, domain, disable=True):
-        # TODO: multi-threaded
+    def __init__(self, store, domain, disable=True, max_in_flight=None, max_bindings=None):
         self.store = store
         self.domain = domain
         self.skeletons = []
-        self.queue = [] # TODO: deque version
+        self.skeletons_from_actions = defaultdict(list) # Indexed by canonical action plan
+        self.num_evicted = 0
+        self.num_equivalent = 0 # Redundant skeletons that are equivalent to an existing skeleton
+        self.num_dominated = 0 # Redundant skeletons whose stream plan contains that of an existing skeleton
+        self.num_saved = 0 # Bindings that redundant skeletons would have recreated
+        self.queue = AddressableHeap(priority_fn=lambda binding: binding.get_priority()) # TODO: deque version
         self.disable = disable
         self.standby = []
+        self.max_in_flight = MAX_IN_FLIGHT if max_in_flight is None else max_in_flight
+        self.max_bindings = MAX_BINDINGS if max_bindings is None else max_bindings
+        # Evicted skeletons are reconstructed by replaying each instance's results_history
+        assert (self.max_bindings == INF) or retains_history(), \
+            'Evicting skeletons requires MAX_HISTORY=INF or a HISTORY_DIR'
 
     @property
     def evaluations(self):
@@ -280,43 +457,144 @@ class SkeletonQueue(Sized):
 
     def push_binding(self, binding):
         # TODO: add to standby if not active
+        # Updates the priority in place if the binding is already queued
         priority = binding.get_priority()
-        element = HeapElement(priority, binding)
-        heappush(self.queue, element)
+        if binding not in self.queue:
+            binding.skeleton.num_queued += 1
+        self.queue.push(priority, binding)
 
     def pop_binding(self):
-        priority, binding = heappop(self.queue)
+        self.prefetch_bindings()
+        priority, binding = self.queue.pop()
+        binding.skeleton.num_queued -= 1
         #return binding
         return priority, binding
 
     def peak_binding(self):
         if not self.queue:
             return None
-        priority, binding = self.queue[0]
+        priority, binding = self.queue.peek()
         return priority, binding
 
+    def peak_bindings(self, num):
+        return self.queue.peek_elements(num)
+
+    def invalidate_bindings(self, skeletons):
+        # Recomputes the priorities of these skeletons' queued bindings when the queue is next queried
+        skeletons = set(skeletons)
+        if skeletons:
+            self.queue.invalidate(lambda binding: binding.skeleton in skeletons)
+
+    def prefetch_bindings(self):
+        # Starts the next stream call of the top bindings in background threads
+        # Their results are still committed one at a time in priority order when each binding is processed
+        if self.max_in_flight <= 1:
+            return 0
+        instances = set()
+        for _, binding in self.peak_bindings(self.max_in_flight):
+            if binding.is_fully_bound or binding.is_dominated() or not binding.up_to_date():
+                continue
+            instance = binding.result.instance
+            if (instance not in instances) and (instance.prefetch(num=1) is not None):
+                instances.add(instance)
+        return len(instances)
+
+    def add_standby(self, binding):
+        binding.skeleton.num_queued += 1
+        self.standby.append(binding)
+
+    def get_dominating(self, stream_plan, action_plan, cost, key=None):
+        # Returns an existing skeleton whose solutions are at least as good as those of the new skeleton
+        # Its action plan is equivalent and its stream plan is either equivalent or a subset of anchored streams
+        if key is None:
+            key = get_skeleton_key(stream_plan, action_plan)
+        anchored = None
+        for skeleton in self.skeletons_from_actions[key.actions]:
+            # A skeleton without queued bindings would not sample the new stream plan
+            if (cost < skeleton.cost) or (skeleton.num_queued == 0):
+                continue
+            if skeleton.key == key:
+                return skeleton
+            if anchored is None:
+                anchored = get_anchored_streams(key)
+            # TODO: injectively match stream-only objects to also detect dominance between their streams
+            if set(skeleton.key.streams) <= anchored:
+                return skeleton
+        return None
+
     def new_skeleton(self, stream_plan, action_plan, cost):
+        key = get_skeleton_key(stream_plan, action_plan)
+        dominating = self.get_dominating(stream_plan, action_plan, cost, key=key)
+        if dominating is not None:
+            # Merges the new skeleton into the existing skeleton, whose binding tree already covers it
+            if dominating.key == key:
+                self.num_equivalent += 1
+            else:
+                self.num_dominated += 1
+            self.num_saved += dominating.num_created
+            print('Skeleton {} dominates the new skeleton | Equivalent: {} | Dominated: {} | Saved bindings: {}'.format(
+                dominating.index, self.num_equivalent, self.num_dominated, self.num_saved))
+            return dominating
         skeleton = Skeleton(self, stream_plan, action_plan, cost)
         self.skeletons.append(skeleton)
+        self.skeletons_from_actions[key.actions].append(skeleton)
         self.push_binding(skeleton.root)
         #self.greedily_process()
         return skeleton
 
     def readd_standby(self):
         for binding in self.standby:
+            binding.skeleton.num_queued -= 1
             self.push_binding(binding)
         self.standby = []
 
+    def get_num_bindings(self):
+        return sum(skeleton.num_bindings for skeleton in self.skeletons)
+
+    def evict_skeletons(self):
+        # Evicts skeletons without queued bindings and then those with the lowest priority bindings
+        # If the optimistic planner returns an evicted skeleton again, new_skeleton reconstructs it from its stream plan
+        # Its bindings are replayed from each instance's results_history without additional stream calls
+        num_bindings = self.get_num_bindings()
+        if num_bindings <= self.max_bindings:
+            return set()
+        best_priorities = {}
+        for priority, binding in self.queue:
+            skeleton = binding.skeleton
+            if (skeleton not in best_priorities) or (priority < best_priorities[skeleton]):
+                best_priorities[skeleton] = priority
+        inactive = [skeleton for skeleton in self.skeletons if skeleton not in best_priorities]
+        active = sorted(best_priorities, key=best_priorities.get, reverse=True)[:-1] # Retains the best
+        evicted = set()
+        for skeleton in inactive + active:
+            if num_bindings <= self.max_bindings:
+                break
+            evicted.add(skeleton)
+            num_bindings -= skeleton.num_bindings
+        self.skeletons = [skeleton for skeleton in self.skeletons if skeleton not in evicted]
+        for skeleton in evicted:
+            self.skeletons_from_actions[skeleton.key.actions].remove(skeleton)
+        for _, binding in list(self.queue):
+            if binding.skeleton in evicted:
+                binding.skeleton.num_queued -= 1
+                self.queue.remove(binding)
+        self.num_evicted += len(evicted)
+        print('Evicted {} skeletons | Bindings: {} | Skeletons: {}'.format(
+            len(evicted), num_bindings, len(self.skeletons)))
+        return evicted
+
     #########################
 
     def _process_binding(self, binding):
         assert binding.calls <= binding.visits # TODO: global DEBUG mode
         readd = is_new = False
         if binding.is_dominated():
+            binding.update_exhausted()
             return readd, is_new
         if binding.is_fully_bound:
             action_plan = binding.skeleton.bind_action_plan(binding.mapping)
             self.store.add_plan(action_plan, binding.cost)
+            binding.update_exhausted()
             is_new = True
             return readd, is_new
         binding.visits += 1
@@ -333,6 +611,7 @@ class SkeletonQueue(Sized):
             is_new = bool(new_results)
         for new_binding in binding.update_bindings():
             self.push_binding(new_binding)
+        binding.update_exhausted()
         readd = not instance.enumerated
         return readd, is_new
 
@@ -370,11 +649,11 @@ class SkeletonQueue(Sized):
             if readd is True:
                 self.push_binding(binding)
             elif readd is STANDBY:
-                self.standby.append(binding) # TODO: test for deciding whether to standby
+                self.add_standby(binding) # TODO: test for deciding whether to standby
             num_new += is_new
             if print_frequency <= elapsed_time(last_time):
-                print('Queue: {} | Iterations: {} | Time: {:.3f}'.format(
-                    len(self.queue), iterations, elapsed_time(last_time)))
+                print('Queue: {} | Stale: {} | Iterations: {} | Time: {:.3f}'.format(
+                    len(self.queue), self.queue.num_stale, iterations, elapsed_time(last_time)))
                 last_time = time.time()
         self.readd_standby()
         return num_new + self.greedily_process()
@@ -394,7 +673,7 @@ class SkeletonQueue(Sized):
                     if readd is True:
                         self.push_binding(binding)
                     continue
-            self.standby.append(binding)
+            self.add_standby(binding)
         self.readd_standby()
         return num_new + self.greedily_process()
         # TODO: increment the complexity level even more if nothing below in the queue
@@ -412,6 +691,19 @@ class SkeletonQueue(Sized):
         #print('Iterations: {} | New: {} | Time: {:.3f}'.format(iterations, num_new, elapsed_time(start_time)))
         return num_new + self.greedily_process()
 
+    def process_until_done(self, future):
+        # Samples while a pipelined optimistic search runs in the background
+        iterations = num_new = 0
+        if not self.is_active():
+            return num_new
+        print('Sampling while searching')
+        start_time = time.time()
+        while self.is_active() and not future.done():
+            iterations += 1
+            num_new += self.process_root()
+        print('Iterations: {} | New: {} | Time: {:.3f}'.format(iterations, num_new, elapsed_time(start_time)))
+        return num_new + self.greedily_process()
+
     #########################
 
     def accelerate_best_bindings(self, **kwargs):
@@ -427,6 +719,8 @@ class SkeletonQueue(Sized):
                 result.call_index = 0 # Pretends the fact was first
                 #print(result.compute_complexity(self.evaluations, **kwargs))
                 add_certified(self.evaluations, result, **kwargs) # TODO: should special have a complexity of INF?
+        self.invalidate_bindings(skeleton for skeleton in self.skeletons
+                                 if skeleton.update_preimage_complexities())
         # TODO: AssertionError: Could not find instantiation for numeric expression: dist
 
     def process(self, stream_plan, action_plan, cost, complexity_limit, max_time=0, accelerate=False):
@@ -445,4 +739,5 @@ class SkeletonQueue(Sized):
         self.process_complexity(complexity_limit)
         if accelerate:
            self.accelerate_best_bindings()
+        self.evict_skeletons()
         return FAILED
@@ -1,16 +1,33 @@
-from collections import Counter
+import os
+import pickle
+import tempfile
+import time
+
+from array import array
+from collections import Counter, deque
+try:
+    from collections import Sized
+except ImportError:
+    from collections.abc import Sized
 
 from pddlstream.algorithms.common import compute_complexity
 from pddlstream.language.constants import get_args, is_parameter, get_prefix, Fact
 from pddlstream.language.conversion import values_from_objects, substitute_fact, obj_from_value_expression
 from pddlstream.language.object import Object, OptimisticObject
-from pddlstream.language.statistics import Performance, PerformanceInfo, DEFAULT_SEARCH_OVERHEAD, Stats
-from pddlstream.utils import elapsed_time, get_mapping, flatten, INF, safe_apply_mapping, Score, INF
+from pddlstream.language.statistics import Performance, PerformanceInfo, DEFAULT_SEARCH_OVERHEAD, Stats, \
+    estimate_p_success, compute_instance_effort
+from pddlstream.utils import elapsed_time, get_mapping, flatten, INF, safe_apply_mapping, Score, INF, safe_zip, \
+    ensure_dir
 
 DEBUG = 'debug'
 SHARED_DEBUG = 'shared_debug'
 DEBUG_MODES = [DEBUG, SHARED_DEBUG]
 
+MAX_HISTORY = INF # The number of most recent calls whose outputs are retained in memory per instance (at least 1)
+HISTORY_DIR = None # If not None, spills evicted results to an on-disk log within this directory
+# The maximum number of instances per batch call, which bounds the evaluation of instances that are never requested
+DEFAULT_BATCH_SIZE = 32
+
 never_defer = lambda *args, **kwargs: False
 defer_unique = lambda result, *args, **kwargs: result.is_refined()
 defer_shared = lambda *args, **kwargs: True
@@ -63,7 +80,102 @@ class ExternalInfo(PerformanceInfo):
 
 ##################################################
 
+class HistoryLog(object):
+    # Append-only log of pickled entries that are recovered by their offsets
+    def __init__(self, directory):
+        ensure_dir(os.path.join(directory, ''))
+        self.file = tempfile.TemporaryFile(prefix='history_', suffix='.pkl', dir=directory) # Removed once closed
+    @property
+    def closed(self):
+        return self.file.closed
+    def close(self):
+        self.file.close()
+    def write(self, data):
+        self.file.seek(0, os.SEEK_END)
+        offset = self.file.tell()
+        pickle.dump(data, self.file, protocol=pickle.HIGHEST_PROTOCOL)
+        return offset
+    def read(self, offset):
+        self.file.seek(offset)
+        return pickle.load(self.file)
+
+HISTORY_LOGS = {}
+
+def get_history_log(directory):
+    if directory not in HISTORY_LOGS:
+        HISTORY_LOGS[directory] = HistoryLog(directory)
+    return HISTORY_LOGS[directory]
+
+def retains_history():
+    # Whether results_history recovers every call, which replaying evicted bindings requires
+    return (MAX_HISTORY == INF) or (HISTORY_DIR is not None)
+
+def close_history_logs():
+    # Entries spilled before closing can no longer be read
+    for log in HISTORY_LOGS.values():
+        log.close()
+    HISTORY_LOGS.clear()
+
+class History(Sized):
+    """
+    A list of per-call outputs that only retains the most recent max_length entries in memory.
+    Evicted entries are spilled to a HistoryLog when encode and decode are provided.
+    Reading an evicted entry that was not spilled raises an error rather than silently dropping its outputs.
+    """
+    def __init__(self, encode=None, decode=None, max_length=None, directory=None):
+        self.encode = encode
+        self.decode = decode
+        self.max_length = max(1, MAX_HISTORY if max_length is None else max_length)
+        self.directory = HISTORY_DIR if directory is None else directory
+        self.items = deque(maxlen=None if self.max_length == INF else self.max_length)
+        self.start = 0 # The index of the first entry retained in memory
+        self.log = None
+        self.offsets = array('q') # The log offsets of spilled entries (-1 if the log was closed)
+        self.num_successes = 0 # The number of nonempty entries
+        self.last_success = -1
+        self.distribution = Counter() # The number of calls between consecutive nonempty entries
+    @property
+    def spills(self):
+        return (self.directory is not None) and (self.encode is not None) and (self.decode is not None)
+    def __len__(self):
+        return self.start + len(self.items)
+    def append(self, item):
+        index = len(self)
+        if item:
+            self.num_successes += 1
+            self.distribution[index - self.last_success] += 1
+            self.last_success = index
+        if len(self.items) == self.max_length:
+            evicted = self.items.popleft()
+            if self.spills:
+                if (self.log is None) or self.log.closed:
+                    self.offsets = array('q', [-1]*len(self.offsets))
+                    self.log = get_history_log(self.directory)
+                self.offsets.append(self.log.write(self.encode(evicted)))
+            self.start += 1
+        self.items.append(item)
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not (0 <= index < len(self)):
+            raise IndexError(index)
+        if self.start <= index:
+            return self.items[index - self.start]
+        if (index < len(self.offsets)) and (0 <= self.offsets[index]) and not self.log.closed:
+            return self.decode(self.log.read(self.offsets[index]))
+        raise RuntimeError('Entry {} of {} was evicted without being spilled (see MAX_HISTORY and HISTORY_DIR)'.format(
+            index, self))
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+    def __repr__(self):
+        return '{}(calls={}, successes={}, retained={})'.format(
+            self.__class__.__name__, len(self), self.num_successes, len(self.items))
+
+##################################################
+
 class Result(object):
+    __slots__ = ['instance', 'opt_index', 'call_index', 'optimistic']
     def __init__(self, instance, opt_index, call_index, optimistic):
         self.instance = instance
         self.opt_index = opt_index
@@ -131,14 +243,16 @@ class Result(object):
 
 class Instance(object):
     _Result = None
+    _Output = list
     def __init__(self, external, input_objects):
         self.external = external
         self.input_objects = tuple(input_objects)
         self.disabled = False # TODO: perform disabled using complexity
-        self.history = [] # TODO: facts history
-        self.results_history = []
+        self.history = History() # TODO: facts history
+        self.results_history = History(encode=self.encode_results, decode=self.decode_results)
         self._mapping = None
         self._domain = None
+        self.batch_overhead = None # Set when evaluated within a batch or prefetched
         self.reset()
     @property
     def info(self):
@@ -187,6 +301,10 @@ class Instance(object):
     def next_results(self, verbose=False):
         raise NotImplementedError()
 
+    def prefetch(self, num=None):
+        # Starts evaluating the next call in the background, if supported
+        return None
+
     def first_results(self, num=1, **kwargs):
         results = []
         index = 0
@@ -208,22 +326,33 @@ class Instance(object):
             results.extend(self.results_history[index])
         return results
 
+    encode_results = decode_results = None # Converts results to and from a picklable form
+
     def compute_complexity(self, evaluations, **kwargs):
         # Will change as self.num_calls increases
         #num_calls = INF if self.enumerated else self.num_calls
         return compute_complexity(evaluations, self.get_domain(), **kwargs) + \
                self.external.get_complexity(self.num_calls)
 
+    def get_p_success(self, sample=False):
+        # Hierarchical Beta-Bernoulli estimate that is shrunk toward the stream-level estimate
+        return estimate_p_success(self.external.get_p_success(), self.results_history.num_successes,
+                                  len(self.results_history), sample=sample)
+
     def get_effort(self, search_overhead=DEFAULT_SEARCH_OVERHEAD):
         # TODO: handle case where resampled several times before the next search (search every ith time)
         replan_effort = self.opt_index * search_overhead  # By linearity of expectation
         effort_fn = self.external.info.effort
         if callable(effort_fn):
             return replan_effort + effort_fn(*self.get_input_values())
+        if effort_fn is None:
+            return replan_effort + compute_instance_effort(self.external, self.results_history.num_successes,
+                                                           len(self.results_history), search_overhead=search_overhead)
         return replan_effort + self.external.get_effort(search_overhead=search_overhead)
 
-    def update_statistics(self, start_time, results):
-        overhead = elapsed_time(start_time)
+    def update_statistics(self, start_time, results, overhead=None):
+        if overhead is None:
+            overhead = elapsed_time(start_time)
         successes = sum(r.is_successful() for r in results)
         self.external.update_statistics(overhead, bool(successes))
         self.results_history.append(results)
@@ -256,6 +385,7 @@ class External(Performance):
             print('Warning! Input [{}] for stream [{}] is not covered by a domain condition'.format(p, name))
         self.constants = {a for i in self.domain for a in get_args(i) if not is_parameter(a)}
         self.instances = {}
+        self.batch_queue = deque() # Instances that have yet to be evaluated by a batch procedure
     def reset(self, *args, **kwargs):
         for instance in self.instances.values():
             instance.reset(*args, **kwargs)
@@ -285,12 +415,38 @@ class External(Performance):
         if self.zero_complexity:
             return 0
         return num_calls + 1
+    @property
+    def is_batched(self):
+        return False
     def get_instance(self, input_objects):
         input_objects = tuple(input_objects)
         assert len(input_objects) == len(self.inputs)
         if input_objects not in self.instances:
-            self.instances[input_objects] = self._Instance(self, input_objects)
+            # setdefault is atomic, so a pipelined search and the skeleton queue share one instance
+            instance = self._Instance(self, input_objects)
+            if self.instances.setdefault(input_objects, instance) is instance:
+                self.queue_batch(instance)
         return self.instances[input_objects]
+    def queue_batch(self, instance):
+        if self.is_batched and all(isinstance(obj, Object) for obj in instance.input_objects):
+            self.batch_queue.append(instance)
+    def evaluate_batch(self, instance, batch_fn, batch_size=INF):
+        # Evaluates instance along with other pending instances in a single call to batch_fn
+        # TODO: order the batch by instance complexity
+        batch = [instance]
+        while self.batch_queue and (len(batch) < batch_size):
+            other = self.batch_queue.popleft()
+            if (other is not instance) and not other.history:
+                batch.append(other)
+        start_time = time.time()
+        outputs = batch_fn([other.get_input_values() for other in batch])
+        if len(outputs) != len(batch):
+            raise ValueError('The batch procedure for external [{}] returned {} outputs for {} inputs'.format(
+                self.name, len(outputs), len(batch)))
+        overhead = elapsed_time(start_time) / len(batch)
+        for other in batch:
+            other.batch_overhead = overhead
+        return list(safe_zip(batch, outputs))
     def overhead_heuristic(self): # Low is little overhead
         # TODO: infer other properties from use in the context of a stream plan
         # TODO: use num_certified (only those that are in another stream) instead of num_outputs?
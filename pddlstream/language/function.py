@@ -2,7 +2,8 @@ import time
 
 from pddlstream.language.conversion import substitute_expression, list_from_conjunction, str_from_head
 from pddlstream.language.constants import Not, Equal, get_prefix, get_args, is_head, FunctionAction
-from pddlstream.language.external import ExternalInfo, Result, Instance, External, DEBUG_MODES, get_procedure_fn
+from pddlstream.language.external import ExternalInfo, Result, Instance, External, DEBUG_MODES, DEFAULT_BATCH_SIZE, \
+    get_procedure_fn
 from pddlstream.utils import str_from_object, apply_mapping
 
 # https://stackoverflow.com/questions/847936/how-can-i-find-the-number-of-arguments-of-a-python-function
@@ -28,13 +29,18 @@ def add_opt_function(name, base_fn, stream_map, stream_info, constant=0., coeffi
 
 class FunctionInfo(ExternalInfo):
     _default_eager = True
-    def __init__(self, opt_fn=None, eager=_default_eager, verbose=True, **kwargs): # Setting eager=True as a heuristic
+    def __init__(self, opt_fn=None, eager=_default_eager, verbose=True,
+                 batch_fn=None, batch_size=DEFAULT_BATCH_SIZE, **kwargs): # Setting eager=True as a heuristic
         super(FunctionInfo, self).__init__(eager=eager, **kwargs)
         self.opt_fn = opt_fn
+        # A vectorized procedure from a list of input value tuples to a list of values
+        self.batch_fn = batch_fn
+        self.batch_size = batch_size
         self.verbose = verbose # TODO: move to ExternalInfo
         #self.order = 0
 
 class FunctionResult(Result):
+    __slots__ = ['value', '_certified']
     def __init__(self, instance, value, optimistic=True):
         super(FunctionResult, self).__init__(instance, opt_index=0, call_index=0, optimistic=optimistic)
         self.instance = instance
@@ -69,6 +75,7 @@ class FunctionInstance(Instance):
     def __init__(self, external, input_objects):
         super(FunctionInstance, self).__init__(external, input_objects)
         self._head = None
+        self._opt_value = None
     @property
     def head(self):
         if self._head is None:
@@ -78,13 +85,12 @@ class FunctionInstance(Instance):
     def value(self):
         assert len(self.history) == 1
         return self.history[0]
-    def _compute_output(self):
-        self.enumerated = True
-        self.num_calls += 1
-        if self.history:
-            return self.value
-        input_values = self.get_input_values()
-        value = self.external.fn(*input_values)
+    @property
+    def opt_value(self):
+        if self._opt_value is None:
+            self._opt_value = self.external.opt_fn(*self.get_input_values())
+        return self._opt_value
+    def _add_value(self, value):
         # TODO: cast the inputs and test whether still equal?
         # if not (type(self.value) is self.external._codomain):
         # if not isinstance(self.value, self.external.codomain):
@@ -92,6 +98,16 @@ class FunctionInstance(Instance):
             raise ValueError('Function [{}] produced a negative value [{}]'.format(self.external.name, value))
         self.history.append(self.external.codomain(value))
         return self.value
+    def _compute_output(self):
+        self.enumerated = True
+        self.num_calls += 1
+        if self.history:
+            return self.value
+        if self.external.is_batched:
+            self.external.batch_evaluate(self)
+            return self.value
+        input_values = self.get_input_values()
+        return self._add_value(self.external.fn(*input_values))
     def next_results(self, verbose=False):
         assert not self.enumerated
         start_time = time.time()
@@ -105,16 +121,18 @@ class FunctionInstance(Instance):
             print('iter={}, outs={}) {}{}={:.3f}'.format(
                 self.get_iteration(), len(new_results), get_prefix(self.external.head),
                 str_from_object(self.get_input_values()), value))
-        if start_history <= len(self.history) - 1:
+        if self.batch_overhead is not None:
+            # Evaluated within a batch, possibly prior to this call
+            self.update_statistics(start_time, new_results, overhead=self.batch_overhead)
+            self.batch_overhead = None
+        elif start_history <= len(self.history) - 1:
             self.update_statistics(start_time, new_results)
         self.successful |= any(r.is_successful() for r in new_results)
         return new_results, new_facts
     def next_optimistic(self):
         if self.enumerated or self.disabled:
             return []
-        # TODO: cache this value
-        opt_value = self.external.opt_fn(*self.get_input_values())
-        self.opt_results = [self._Result(self, opt_value, optimistic=True)]
+        self.opt_results = [self._Result(self, self.opt_value, optimistic=True)]
         return self.opt_results
     def __repr__(self):
         return '{}=?{}'.format(str_from_head(self.head), self.external.codomain.__name__)
@@ -146,6 +164,14 @@ class Function(External):
     def function(self):
         return get_prefix(self.head)
     @property
+    def is_batched(self):
+        return self.info.batch_fn is not None
+    def batch_evaluate(self, instance):
+        outputs = self.evaluate_batch(instance, self.info.batch_fn, batch_size=self.info.batch_size)
+        for other, value in outputs:
+            other._add_value(value)
+        return outputs
+    @property
     def has_outputs(self):
         return False
     @property
@@ -169,13 +195,13 @@ class PredicateInfo(FunctionInfo):
     _default_eager = False
 
 class PredicateResult(FunctionResult):
+    __slots__ = []
     def get_certified(self):
         # TODO: cache these results
         expression = self.instance.head
         return [expression if self.value else Not(expression)]
     def is_successful(self):
-        opt_value = self.external.opt_fn(*self.instance.get_input_values())
-        return self.value == opt_value
+        return self.value == self.instance.opt_value
 
 class PredicateInstance(FunctionInstance):
     _Result = PredicateResult
@@ -95,6 +95,11 @@ def from_test(test):
     return from_fn(lambda *args, **kwargs: outputs_from_boolean(test(*args, **kwargs)))
 
 
+def from_batch_test(batch_test):
+    # Per-tuple fallback for a vectorized test that is also passed as StreamInfo(batch_test=batch_test)
+    return from_test(lambda *args: batch_test([args])[0])
+
+
 def from_constant(constant):
     return from_fn(fn_from_constant(constant))
 
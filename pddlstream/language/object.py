@@ -1,10 +1,12 @@
-from collections import namedtuple, defaultdict
+from collections import namedtuple, defaultdict, Counter
 from itertools import count
 from pddlstream.language.constants import get_parameter_name
 #from pddlstream.language.conversion import values_from_objects
-from pddlstream.utils import str_from_object, is_hashable
+from pddlstream.utils import str_from_object, is_hashable, hash_value
 
 USE_HASH = True
+CANONICALIZE = False # Maps unhashable values (e.g. numpy arrays) with equal contents to the same Object
+CANONICAL_DIGITS = 6 # The rounding tolerance (decimal places) used when canonicalizing (None is exact)
 USE_OBJ_STR = True
 USE_OPT_STR = True
 OPT_PREFIX = '#'
@@ -15,6 +17,8 @@ class Object(object):
     _obj_from_id = {}
     _obj_from_value = {}
     _obj_from_name = {}
+    _obj_from_key = {}
+    _canonical_counts = Counter()
     def __init__(self, value, stream_instance=None, name=None):
         self.value = value
         self.index = len(Object._obj_from_name)
@@ -37,14 +41,30 @@ class Object(object):
             return Object(value)
         return Object._obj_from_id[id(value)]
     @staticmethod
+    def get_key(value):
+        if not CANONICALIZE:
+            return None
+        return hash_value(value, ndigits=CANONICAL_DIGITS)
+    @staticmethod
+    def from_key(value):
+        key = Object.get_key(value)
+        if (key is None) or (id(value) in Object._obj_from_id):
+            return Object.from_id(value)
+        if key not in Object._obj_from_key:
+            Object._canonical_counts['misses'] += 1
+            Object._obj_from_key[key] = Object.from_id(value)
+        else:
+            Object._canonical_counts['hits'] += 1 # An equal value was previously created
+        return Object._obj_from_key[key]
+    @staticmethod
     def has_value(value):
         if USE_HASH and not is_hashable(value):
-            return id(value) in Object._obj_from_id
+            return (id(value) in Object._obj_from_id) or (Object.get_key(value) in Object._obj_from_key)
         return value in Object._obj_from_value
     @staticmethod
     def from_value(value):
         if USE_HASH and not is_hashable(value):
-            return Object.from_id(value)
+            return Object.from_key(value)
         if value not in Object._obj_from_value:
             return Object(value)
         return Object._obj_from_value[value]
@@ -56,6 +76,15 @@ class Object(object):
         Object._obj_from_id.clear()
         Object._obj_from_value.clear()
         Object._obj_from_name.clear()
+        Object._obj_from_key.clear()
+        Object._canonical_counts.clear()
+    @staticmethod
+    def get_canonical_statistics():
+        # Each hit is a duplicate Object (and its downstream stream instances) that was not created
+        return {
+            'canonical_hits': Object._canonical_counts['hits'],
+            'canonical_misses': Object._canonical_counts['misses'],
+        }
     def __lt__(self, other): # For heapq on python3
         return self.index < other.index
     def __repr__(self):
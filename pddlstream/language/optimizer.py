@@ -8,7 +8,6 @@ from pddlstream.language.function import PredicateResult, FunctionResult
 from pddlstream.language.object import Object, SharedOptValue
 from pddlstream.language.stream import StreamInfo, Stream, StreamInstance, StreamResult, \
     PartialInputs, NEGATIVE_SUFFIX, WildOutput
-from pddlstream.language.generator import get_next
 from pddlstream.utils import INF, get_mapping, safe_zip, str_from_object
 from pddlstream.algorithms.reorder import get_stream_plan_components, get_partial_orders
 
@@ -166,6 +165,7 @@ def parse_optimizer(lisp_list, procedures, infos):
 ##################################################
 
 class OptimizerResult(StreamResult):
+    __slots__ = []
     def get_components(self):
         return self.external.stream_plan
     def get_objectives(self):
@@ -186,7 +186,7 @@ class OptimizerInstance(StreamInstance):
         # TODO: compute things dependent on a stream and treat like an optimizer
         # Also make an option to just treat everything like an optimizer
     def _next_wild(self):
-        output, self.enumerated = get_next(self._generator, default=[])
+        output, self.enumerated = self._get_next()
         if not isinstance(output, OptimizerOutput):
             output = OptimizerOutput(assignments=output)
         self.infeasible.update(output.infeasible)
@@ -0,0 +1,210 @@
+from __future__ import print_function
+
+import importlib
+import multiprocessing
+import threading
+import traceback
+
+from collections import namedtuple
+from itertools import count
+
+import numpy as np
+
+from pddlstream.language import generator as generators
+from pddlstream.language.generator import BoundedGenerator, get_next
+from pddlstream.utils import Saver, INF
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError: # Python < 3.8
+    shared_memory = resource_tracker = None
+
+# TODO: generalize to optimizers and functions
+
+MIN_SHARED_BYTES = 2**16 # Smaller arrays are simply pickled through the pipe
+
+CREATE = 'create'
+NEXT = 'next'
+CLOSE = 'close'
+STOP = 'stop'
+
+# A picklable reference to a procedure defined within a module that each worker imports once
+# conversion optionally names a pddlstream.language.generator method applied to the loaded procedure
+Procedure = namedtuple('Procedure', ['module', 'name', 'args', 'conversion'])
+SharedArray = namedtuple('SharedArray', ['name', 'shape', 'dtype'])
+
+##################################################
+
+def encode_value(value, min_bytes=MIN_SHARED_BYTES):
+    # Moves large numpy arrays into shared memory blocks that are released by the receiver
+    if isinstance(value, np.ndarray) and (shared_memory is not None) and \
+            (value.dtype != object) and (min_bytes <= value.nbytes):
+        block = shared_memory.SharedMemory(create=True, size=value.nbytes)
+        np.ndarray(value.shape, dtype=value.dtype, buffer=block.buf)[...] = value
+        resource_tracker.unregister(block._name, 'shared_memory') # The receiver unlinks the block
+        block.close()
+        return SharedArray(block.name, value.shape, value.dtype.str)
+    if type(value) in [list, tuple]:
+        return type(value)(encode_value(item, min_bytes=min_bytes) for item in value)
+    if type(value) is dict:
+        return {key: encode_value(item, min_bytes=min_bytes) for key, item in value.items()}
+    return value
+
+def decode_value(value):
+    if isinstance(value, SharedArray):
+        block = shared_memory.SharedMemory(name=value.name)
+        array = np.ndarray(value.shape, dtype=np.dtype(value.dtype), buffer=block.buf).copy()
+        block.close()
+        block.unlink()
+        return array
+    if type(value) in [list, tuple]:
+        return type(value)(map(decode_value, value))
+    if type(value) is dict:
+        return {key: decode_value(item) for key, item in value.items()}
+    return value
+
+##################################################
+
+def load_procedure(procedure):
+    module = importlib.import_module(procedure.module)
+    fn = getattr(module, procedure.name)
+    if procedure.args is not None:
+        fn = fn(*procedure.args) # Factory (e.g. get_pose_gen(regions))
+    if procedure.conversion is not None:
+        fn = getattr(generators, procedure.conversion)(fn)
+    return fn
+
+def worker_loop(connection):
+    procedures = {}
+    generator_from_key = {}
+    while True:
+        message = connection.recv()
+        command = message[0]
+        if command == STOP:
+            break
+        try:
+            reply = None
+            if command == CREATE:
+                _, key, procedure_index, procedure, input_values, kwargs = message
+                if procedure_index not in procedures:
+                    procedures[procedure_index] = load_procedure(procedure)
+                generator_from_key[key] = procedures[procedure_index](
+                    *decode_value(input_values), **decode_value(kwargs))
+            elif command == NEXT:
+                _, key = message
+                new_values, enumerated = get_next(generator_from_key[key], default=[])
+                if enumerated:
+                    del generator_from_key[key]
+                reply = (encode_value(new_values), enumerated)
+            elif command == CLOSE:
+                _, key = message
+                generator_from_key.pop(key, None)
+            else:
+                raise ValueError(command)
+            connection.send((True, reply))
+        except Exception:
+            connection.send((False, traceback.format_exc()))
+    connection.close()
+
+##################################################
+
+class Worker(object):
+    def __init__(self, context):
+        self.connection, worker_connection = context.Pipe()
+        self.process = context.Process(target=worker_loop, args=(worker_connection,))
+        self.process.daemon = True
+        self.process.start()
+        worker_connection.close()
+        self.lock = threading.Lock() # Requests from several threads are serialized per worker
+        self.procedures = set()
+        self.num_generators = 0
+    def request(self, *message):
+        with self.lock:
+            self.connection.send(message)
+            success, reply = self.connection.recv()
+        if not success:
+            raise RuntimeError('Stream worker {} failed:\n{}'.format(self.process.pid, reply))
+        return reply
+    def stop(self):
+        with self.lock:
+            if self.process.is_alive():
+                self.connection.send((STOP,))
+            self.process.join()
+            self.connection.close()
+
+class WorkerGenerator(BoundedGenerator):
+    """
+    A generator whose procedure runs within a WorkerPool process.
+    Only values cross the process boundary, so Object identity is maintained in the parent.
+    """
+    def __init__(self, worker, key, max_calls=INF):
+        super(WorkerGenerator, self).__init__(generator=None, max_calls=max_calls)
+        self.worker = worker
+        self.key = key
+    def next(self):
+        if self.enumerated:
+            raise StopIteration()
+        new_values, enumerated = self.worker.request(NEXT, self.key)
+        self.history.append(decode_value(new_values))
+        if enumerated:
+            self.stopped = True
+            self.worker.num_generators -= 1
+        return self.history[-1]
+    __next__ = next
+    def close(self):
+        if not self.stopped:
+            self.stopped = True
+            self.worker.num_generators -= 1
+            self.worker.request(CLOSE, self.key)
+
+class WorkerPool(Saver):
+    """
+    Evaluates stream procedures in separate processes to avoid the GIL.
+    Each worker imports a procedure's module once, and each generator is pinned to the worker that created it.
+    See pddlstream_from_tamp in examples/continuous_tamp/run.py (--workers) for a stream_map that uses get_gen_fn.
+    """
+    def __init__(self, num_workers=None, start_method=None, min_shared_bytes=MIN_SHARED_BYTES):
+        self.num_workers = multiprocessing.cpu_count() if num_workers is None else num_workers
+        self.context = multiprocessing.get_context(start_method)
+        self.min_shared_bytes = min_shared_bytes
+        self.workers = []
+        self.procedures = []
+        self.keys = count()
+    def start(self):
+        while len(self.workers) < self.num_workers:
+            self.workers.append(Worker(self.context))
+        return self.workers
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+        self.workers = []
+    def save(self):
+        self.start()
+    def restore(self):
+        self.close()
+    def create_generator(self, procedure_index, input_values, kwargs):
+        self.start()
+        worker = min(self.workers, key=lambda w: w.num_generators) # Least loaded
+        key = next(self.keys)
+        procedure = None if procedure_index in worker.procedures else self.procedures[procedure_index]
+        worker.request(CREATE, key, procedure_index, procedure,
+                       encode_value(input_values, min_bytes=self.min_shared_bytes),
+                       encode_value(kwargs, min_bytes=self.min_shared_bytes))
+        worker.procedures.add(procedure_index)
+        worker.num_generators += 1
+        return WorkerGenerator(worker, key)
+    def get_gen_fn(self, module, name, args=None, conversion=None):
+        """
+        :param module: the name of the module defining the procedure (e.g. examples.continuous_tamp.primitives)
+        :param name: the name of the procedure within module
+        :param args: if not None, the procedure is a factory that is called once per worker with args
+        :param conversion: if not None, the name of the generator method applied to the procedure (e.g. from_gen_fn)
+        :return: a gen_fn for use within a stream_map
+        """
+        procedure_index = len(self.procedures)
+        self.procedures.append(Procedure(module, name, args, conversion))
+        def gen_fn(*input_values, **kwargs):
+            return self.create_generator(procedure_index, input_values, kwargs)
+        return gen_fn
+    def __repr__(self):
+        return '{}(workers={})'.format(self.__class__.__name__, self.num_workers)
@@ -1,7 +1,12 @@
 from __future__ import print_function
 
+import argparse
+import math
 import os
 import pickle
+import random
+import sqlite3
+import time
 
 from collections import Counter, namedtuple
 
@@ -10,8 +15,25 @@ from pddlstream.utils import INF, read_pickle, ensure_dir, write_pickle, get_pyt
 
 LOAD_STATISTICS = True
 SAVE_STATISTICS = True
+USE_DATABASE = True # Stores statistics within a SQLite database instead of a pickle per domain
 
 DATA_DIR = 'statistics/py{:d}/'
+DATABASE_NAME = 'statistics.db'
+DATABASE_TIMEOUT = 60 # Seconds to wait for concurrent writers
+RESERVOIR_SIZE = 100 # The number of sampled distribution values retained per external
+SKETCH_ACCURACY = 0.02 # Relative accuracy of overhead quantiles (persisted sketches assume it is fixed)
+MIN_LATENCY = 1e-6 # Overheads below this value share a bucket
+TAIL_QUANTILE = None # If not None, effort uses this overhead quantile (e.g. 0.95) instead of the mean
+MIN_TAIL_CALLS = 10 # The number of calls required before the overhead quantile is trusted
+MAX_BUCKETS = 256 # The number of LatencySketch buckets retained per external
+DECAY_HALF_LIFE = None # Seconds after which previous statistics weigh half as much (None disables decay)
+DECAYED_KEYS = ['calls', 'successes', 'overhead', 'overhead_sq', 'samples', 'sample_sum', 'sample_sq']
+ALLOCATION_WEIGHT = 0.5 # Weight of the latest run when persisting the tuned time allocation of a domain
+
+MEAN = 'mean'
+THOMPSON = 'thompson'
+INSTANCE_ESTIMATE = None # None (per stream), MEAN (per instance posterior mean), or THOMPSON (per instance posterior sample)
+INSTANCE_STRENGTH = 5. # Pseudo-calls that shrink each instance's estimate toward the stream's estimate
 DEFAULT_SEARCH_OVERHEAD = 1e2 # TODO: update this over time
 EPSILON = 1e-6
 # Can also include the overhead to process skeletons
@@ -28,6 +50,51 @@ def safe_ratio(numerator, denominator, undefined=None):
 def geometric_cost(cost, p):
     return safe_ratio(cost, p, undefined=INF)
 
+def get_decay(updated, current_time=None, half_life=None):
+    # Exponential time decay of statistics last updated at time updated
+    if half_life is None:
+        half_life = DECAY_HALF_LIFE
+    if (half_life is None) or (updated is None):
+        return 1.
+    if current_time is None:
+        current_time = time.time()
+    return 0.5 ** (max(0., current_time - updated) / half_life)
+
+def decay_statistics(statistics, current_time=None, **kwargs):
+    if current_time is None:
+        current_time = time.time()
+    decay = get_decay(statistics.get('updated'), current_time=current_time, **kwargs)
+    if decay == 1.:
+        return statistics
+    decayed = dict(statistics)
+    for key in DECAYED_KEYS:
+        if key in decayed:
+            decayed[key] *= decay
+    decayed['latencies'] = {bucket: decay * count for bucket, count in statistics.get('latencies', {}).items()}
+    decayed['updated'] = current_time
+    return decayed
+
+def compute_effort(overhead, p_success, search_overhead=DEFAULT_SEARCH_OVERHEAD):
+    return geometric_cost(overhead, p_success) + \
+           (1 - p_success) * geometric_cost(search_overhead, p_success)
+
+def beta_posterior(mean, successes, calls, strength=INSTANCE_STRENGTH):
+    # Beta prior with the given mean and strength pseudo-calls updated by Bernoulli observations
+    mean = min(max(mean, EPSILON), 1 - EPSILON)
+    return strength * mean + successes, strength * (1 - mean) + (calls - successes)
+
+def estimate_p_success(mean, successes, calls, sample=False, **kwargs):
+    alpha, beta = beta_posterior(mean, successes, calls, **kwargs)
+    if sample:
+        return random.betavariate(alpha, beta) # Thompson sampling
+    return alpha / (alpha + beta)
+
+def compute_instance_effort(external, successes, calls, search_overhead=DEFAULT_SEARCH_OVERHEAD):
+    if INSTANCE_ESTIMATE is None:
+        return external.get_effort(search_overhead=search_overhead)
+    p_success = estimate_p_success(external.get_p_success(), successes, calls, sample=(INSTANCE_ESTIMATE == THOMPSON))
+    return compute_effort(external.get_overhead(quantile=TAIL_QUANTILE), p_success, search_overhead)
+
 def check_effort(effort, max_effort):
     if max_effort is None:
         return True
@@ -45,6 +112,62 @@ def compute_plan_effort(stream_plan, **kwargs):
 
 # TODO: write to a "local" folder containing temp, data2, data3, visualizations
 
+class LatencySketch(object):
+    """
+    A mergeable histogram with logarithmically spaced buckets (as in DDSketch or HDR histograms).
+    Quantiles are within a relative error of accuracy using a number of buckets logarithmic in the range.
+    """
+    def __init__(self, buckets={}, accuracy=SKETCH_ACCURACY):
+        self.gamma = (1. + accuracy) / (1. - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = Counter()
+        self.count = 0
+        self.update(buckets)
+    def get_bucket(self, value):
+        return int(math.ceil(math.log(max(value, MIN_LATENCY)) / self.log_gamma))
+    def get_value(self, bucket):
+        return 2 * self.gamma ** bucket / (self.gamma + 1) # Representative value of (gamma^(b-1), gamma^b]
+    def add(self, value, count=1):
+        self.buckets[self.get_bucket(value)] += count
+        self.count += count
+    def update(self, buckets):
+        for bucket, count in buckets.items():
+            self.buckets[bucket] += count
+            self.count += count
+    def merge(self, other):
+        sketch = LatencySketch(self.buckets)
+        sketch.update(other.buckets)
+        return sketch
+    def collapse(self, max_buckets=MAX_BUCKETS):
+        # Merges the lowest buckets, which preserves the accuracy of the upper quantiles
+        buckets = sorted(self.buckets)
+        if len(buckets) <= max_buckets:
+            return self
+        lowest = buckets[-max_buckets]
+        for bucket in buckets[:-max_buckets]:
+            self.buckets[lowest] += self.buckets.pop(bucket)
+        return self
+    def quantile(self, q):
+        assert 0. <= q <= 1.
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        total = 0
+        for bucket in sorted(self.buckets):
+            total += self.buckets[bucket]
+            if rank < total:
+                return self.get_value(bucket)
+        return self.get_value(max(self.buckets))
+    def __len__(self):
+        return self.count
+    def __repr__(self):
+        if not self.count:
+            return '{}()'.format(self.__class__.__name__)
+        return '{}(n={}, p50={:.3f}, p99={:.3f})'.format(
+            self.__class__.__name__, self.count, self.quantile(0.5), self.quantile(0.99))
+
+##################################################
+
 def get_data_path(stream_name):
     data_dir = DATA_DIR.format(get_python_version())
     file_name = '{}.pkl'.format(stream_name)
@@ -53,6 +176,13 @@ def get_data_path(stream_name):
 def load_data(pddl_name):
     if not LOAD_STATISTICS:
         return {}
+    if USE_DATABASE:
+        data = load_database(pddl_name)
+        if data:
+            return data
+    return load_pickle_data(pddl_name)
+
+def load_pickle_data(pddl_name):
     filename = get_data_path(pddl_name)
     if not os.path.exists(filename):
         return {}
@@ -68,10 +198,10 @@ def load_stream_statistics(externals):
         return
     pddl_name = externals[0].pddl_name # TODO: ensure the same
     # TODO: fresh restart flag
-    data = load_data(pddl_name)
+    data = load_data(pddl_name) # Indexed by (pddl_name, name) when USE_DATABASE
     for external in externals:
         if external.name in data:
-            external.load_statistics(data[external.name])
+            external.load_statistics(decay_statistics(data[external.name]))
 
 ##################################################
 
@@ -93,24 +223,24 @@ def dump_total_statistics(externals):
 
 ##################################################
 
+def get_distribution(external):
+    distribution = []
+    for instance in external.instances.values():
+        # The History maintains the number of calls between consecutive successes
+        distribution.extend(sorted(instance.results_history.distribution.elements()))
+    return distribution
+
 def merge_data(external, previous_data):
     # TODO: compute distribution of successes given feasible
     # TODO: can estimate probability of success given feasible
     # TODO: single tail hypothesis testing (probability that came from this distribution)
-    distribution = []
-    for instance in external.instances.values():
-        if instance.results_history:
-            # attempts = len(instance.results_history)
-            # successes = sum(map(bool, instance.results_history))
-            # print(instance, successes, attempts)
-            # TODO: also first attempt, first success
-            last_success = -1
-            for i, results in enumerate(instance.results_history):
-                if results:
-                    distribution.append(i - last_success)
-                    # successful = (0 <= last_success)
-                    last_success = i
+    # TODO: also first attempt, first success
+    current_time = time.time()
+    previous_data = decay_statistics(previous_data, current_time=current_time)
+    distribution = get_distribution(external)
     combined_distribution = previous_data.get('distribution', []) + distribution
+    if len(combined_distribution) > RESERVOIR_SIZE:
+        combined_distribution = random.sample(combined_distribution, RESERVOIR_SIZE)
     # print(external, distribution)
     # print(external, Counter(combined_distribution))
     # TODO: count num failures as well
@@ -121,6 +251,13 @@ def merge_data(external, previous_data):
         'overhead': external.total_overhead,
         'successes': external.total_successes,
         'distribution': combined_distribution,
+        # Summarizes the full distribution, while the above is a bounded sample
+        'samples': previous_data.get('samples', len(previous_data.get('distribution', []))) + len(distribution),
+        'sample_sum': previous_data.get('sample_sum', sum(previous_data.get('distribution', []))) + sum(distribution),
+        'sample_sq': previous_data.get('sample_sq', sum(v ** 2 for v in previous_data.get('distribution', []))) +
+                     sum(v ** 2 for v in distribution),
+        'latencies': dict(external.get_sketch().collapse().buckets),
+        'updated': current_time,
     }
     # TODO: make an instance method
 
@@ -135,7 +272,13 @@ def write_stream_statistics(externals, verbose):
         #dump_online_statistics(externals)
         dump_total_statistics(externals)
     pddl_name = externals[0].pddl_name # TODO: ensure the same
-    previous_data = load_data(pddl_name)
+    if USE_DATABASE:
+        if SAVE_STATISTICS:
+            filename = write_database(pddl_name, externals)
+            if verbose:
+                print('Wrote:', filename)
+        return
+    previous_data = load_pickle_data(pddl_name)
     data = {}
     for external in externals:
         if not hasattr(external, 'instances'):
@@ -154,6 +297,265 @@ def write_stream_statistics(externals, verbose):
 
 ##################################################
 
+# Bounded aggregates per (pddl_name, name) that are incrementally updated by each process
+CREATE_TABLES = [
+    '''CREATE TABLE IF NOT EXISTS statistics (
+        pddl_name TEXT NOT NULL, name TEXT NOT NULL,
+        calls INTEGER NOT NULL, successes INTEGER NOT NULL,
+        overhead REAL NOT NULL, overhead_sq REAL NOT NULL,
+        samples INTEGER NOT NULL, sample_sum REAL NOT NULL, sample_sq REAL NOT NULL, updated REAL,
+        PRIMARY KEY (pddl_name, name))''',
+    '''CREATE TABLE IF NOT EXISTS reservoirs (
+        pddl_name TEXT NOT NULL, name TEXT NOT NULL, slot INTEGER NOT NULL, value REAL NOT NULL,
+        PRIMARY KEY (pddl_name, name, slot))''',
+    '''CREATE TABLE IF NOT EXISTS latencies (
+        pddl_name TEXT NOT NULL, name TEXT NOT NULL, bucket INTEGER NOT NULL, count INTEGER NOT NULL,
+        PRIMARY KEY (pddl_name, name, bucket))''',
+    '''CREATE TABLE IF NOT EXISTS allocations (
+        pddl_name TEXT NOT NULL PRIMARY KEY, search_sample_ratio REAL NOT NULL, max_planner_time REAL NOT NULL,
+        runs INTEGER NOT NULL, updated REAL)''',
+]
+
+UPSERT_LATENCY = '''INSERT INTO latencies VALUES (?, ?, ?, ?)
+    ON CONFLICT (pddl_name, name, bucket) DO UPDATE SET count = count + excluded.count'''
+
+UPSERT_STATISTICS = '''INSERT INTO statistics
+    (pddl_name, name, calls, successes, overhead, overhead_sq, samples, sample_sum, sample_sq, updated)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (pddl_name, name) DO UPDATE SET
+        calls = calls + excluded.calls, successes = successes + excluded.successes,
+        overhead = overhead + excluded.overhead, overhead_sq = overhead_sq + excluded.overhead_sq,
+        samples = samples + excluded.samples, sample_sum = sample_sum + excluded.sample_sum,
+        sample_sq = sample_sq + excluded.sample_sq, updated = excluded.updated'''
+
+DECAY_STATISTICS = 'UPDATE statistics SET {}, updated = ? WHERE pddl_name = ? AND name = ?'.format(
+    ', '.join('{0} = ? * {0}'.format(key) for key in DECAYED_KEYS))
+
+def get_database_path():
+    data_dir = DATA_DIR.format(get_python_version())
+    return os.path.join(data_dir, DATABASE_NAME)
+
+def connect_database(path=None):
+    if path is None:
+        path = get_database_path()
+    ensure_dir(path)
+    connection = sqlite3.connect(path, timeout=DATABASE_TIMEOUT, isolation_level=None) # Explicit transactions
+    connection.execute('PRAGMA journal_mode=WAL') # Readers do not block the writer
+    for command in CREATE_TABLES:
+        connection.execute(command)
+    columns = {row[1] for row in connection.execute('PRAGMA table_info(statistics)')}
+    if 'updated' not in columns: # Databases written prior to decay
+        connection.execute('ALTER TABLE statistics ADD COLUMN updated REAL')
+    return connection
+
+def decay_database(connection, pddl_name, name, updated, current_time, **kwargs):
+    decay = get_decay(updated, current_time=current_time, **kwargs)
+    if decay < 1.:
+        connection.execute(DECAY_STATISTICS, len(DECAYED_KEYS)*(decay,) + (current_time, pddl_name, name))
+        connection.execute('UPDATE latencies SET count = ? * count WHERE pddl_name = ? AND name = ?',
+                           (decay, pddl_name, name))
+    return decay
+
+def load_database(pddl_name, path=None):
+    if path is None:
+        path = get_database_path()
+    if not os.path.exists(path):
+        return {}
+    connection = connect_database(path)
+    try:
+        data = {}
+        for name, calls, successes, overhead, overhead_sq, samples, sample_sum, sample_sq, updated in \
+                connection.execute('SELECT name, calls, successes, overhead, overhead_sq, '
+                                   'samples, sample_sum, sample_sq, updated FROM statistics WHERE pddl_name = ?',
+                                   (pddl_name,)):
+            data[name] = {
+                'calls': calls,
+                'overhead': overhead,
+                'successes': successes,
+                'overhead_sq': overhead_sq,
+                'samples': samples,
+                'sample_sum': sample_sum,
+                'sample_sq': sample_sq,
+                'distribution': [], # A reservoir sample of the full distribution
+                'latencies': {}, # LatencySketch buckets
+                'updated': updated,
+            }
+        for name, value in connection.execute(
+                'SELECT name, value FROM reservoirs WHERE pddl_name = ? ORDER BY name, slot', (pddl_name,)):
+            if name in data:
+                data[name]['distribution'].append(value)
+        for name, bucket, count in connection.execute(
+                'SELECT name, bucket, count FROM latencies WHERE pddl_name = ?', (pddl_name,)):
+            if name in data:
+                data[name]['latencies'][bucket] = count
+        return data
+    finally:
+        connection.close()
+
+def update_reservoir(connection, pddl_name, name, num_samples, values, max_size=RESERVOIR_SIZE):
+    # Reservoir sampling (Algorithm R) given the number of samples previously observed
+    # Decayed sample counts favor replacing entries with recent values
+    num_samples = int(num_samples)
+    for value in values:
+        slot = num_samples if num_samples < max_size else random.randint(0, num_samples)
+        if slot < max_size:
+            connection.execute('INSERT OR REPLACE INTO reservoirs VALUES (?, ?, ?, ?)',
+                               (pddl_name, name, slot, value))
+        num_samples += 1
+    return num_samples
+
+def import_pickle_data(connection, pddl_name):
+    # Migrates statistics previously written as a pickle
+    if connection.execute('SELECT 1 FROM statistics WHERE pddl_name = ? LIMIT 1', (pddl_name,)).fetchone():
+        return False
+    previous_data = load_pickle_data(pddl_name)
+    for name, statistics in previous_data.items():
+        distribution = statistics.get('distribution', [])
+        mean_overhead = safe_ratio(statistics['overhead'], statistics['calls'], undefined=0.)
+        connection.execute(UPSERT_STATISTICS, (
+            pddl_name, name, statistics['calls'], statistics['successes'], statistics['overhead'],
+            statistics['calls'] * mean_overhead ** 2, # Lower bound as the individual overheads are unknown
+            statistics.get('samples', len(distribution)), statistics.get('sample_sum', sum(distribution)),
+            statistics.get('sample_sq', sum(v ** 2 for v in distribution)), statistics.get('updated')))
+        update_reservoir(connection, pddl_name, name, 0, distribution)
+        for bucket, count in statistics.get('latencies', {}).items():
+            connection.execute(UPSERT_LATENCY, (pddl_name, name, bucket, count))
+    return bool(previous_data)
+
+def write_database(pddl_name, externals, path=None):
+    # Only adds this process's online statistics, so concurrent writers do not overwrite each other
+    if path is None:
+        path = get_database_path()
+    connection = connect_database(path)
+    current_time = time.time()
+    try:
+        connection.execute('BEGIN IMMEDIATE') # Acquires the write lock before reading reservoir sizes
+        import_pickle_data(connection, pddl_name)
+        for external in externals:
+            if not hasattr(external, 'instances'):
+                continue # TODO: SynthesizerStreams
+            distribution = get_distribution(external)
+            row = connection.execute('SELECT samples, updated FROM statistics WHERE pddl_name = ? AND name = ?',
+                                     (pddl_name, external.name)).fetchone()
+            num_samples = 0
+            if row is not None:
+                num_samples, updated = row
+                num_samples *= decay_database(connection, pddl_name, external.name, updated, current_time)
+            connection.execute(UPSERT_STATISTICS, (
+                pddl_name, external.name, external.online_calls, external.online_successes,
+                external.online_overhead, external.online_overhead_sq,
+                len(distribution), sum(distribution), sum(v ** 2 for v in distribution), current_time))
+            update_reservoir(connection, pddl_name, external.name, num_samples, distribution)
+            for bucket, count in external.online_sketch.buckets.items():
+                connection.execute(UPSERT_LATENCY, (pddl_name, external.name, bucket, count))
+        connection.execute('COMMIT')
+    except:
+        if connection.in_transaction:
+            connection.execute('ROLLBACK')
+        raise
+    finally:
+        connection.close()
+    return path
+
+def compact_database(path=None, half_life=None, max_buckets=MAX_BUCKETS):
+    # Applies decay up to the current time and caps the entries retained per external
+    # Reservoirs are capped at RESERVOIR_SIZE, the size that update_reservoir maintains
+    if path is None:
+        path = get_database_path()
+    connection = connect_database(path)
+    current_time = time.time()
+    try:
+        connection.execute('BEGIN IMMEDIATE')
+        for pddl_name, name, updated in connection.execute(
+                'SELECT pddl_name, name, updated FROM statistics').fetchall():
+            decay_database(connection, pddl_name, name, updated, current_time, half_life=half_life)
+            connection.execute('DELETE FROM reservoirs WHERE pddl_name = ? AND name = ? AND slot >= ?',
+                               (pddl_name, name, RESERVOIR_SIZE))
+            sketch = LatencySketch(dict(connection.execute(
+                'SELECT bucket, count FROM latencies WHERE pddl_name = ? AND name = ?', (pddl_name, name))))
+            if len(sketch.buckets) > max_buckets:
+                connection.execute('DELETE FROM latencies WHERE pddl_name = ? AND name = ?', (pddl_name, name))
+                for bucket, count in sketch.collapse(max_buckets).buckets.items():
+                    connection.execute(UPSERT_LATENCY, (pddl_name, name, bucket, count))
+        connection.execute('COMMIT')
+        connection.execute('VACUUM')
+    except:
+        if connection.in_transaction:
+            connection.execute('ROLLBACK')
+        raise
+    finally:
+        connection.close()
+    return path
+
+##################################################
+
+# The time allocation of solve_abstract that was tuned by an AllocationController on previous runs
+
+Allocation = namedtuple('Allocation', ['search_sample_ratio', 'max_planner_time'])
+
+def get_allocation_path(pddl_name):
+    return get_data_path('{}_allocation'.format(pddl_name))
+
+def merge_allocations(previous, allocation, weight=ALLOCATION_WEIGHT):
+    # Both parameters are scales, so runs are averaged geometrically
+    if previous is None:
+        return allocation
+    return Allocation(*[math.exp((1 - weight) * math.log(old) + weight * math.log(new))
+                        for old, new in zip(previous, allocation)])
+
+def load_allocation(pddl_name):
+    if not LOAD_STATISTICS:
+        return None
+    if USE_DATABASE:
+        path = get_database_path()
+        if os.path.exists(path):
+            connection = connect_database(path)
+            try:
+                row = connection.execute('SELECT search_sample_ratio, max_planner_time FROM allocations '
+                                         'WHERE pddl_name = ?', (pddl_name,)).fetchone()
+            finally:
+                connection.close()
+            if row is not None:
+                return Allocation(*row)
+    filename = get_allocation_path(pddl_name)
+    if not os.path.exists(filename):
+        return None
+    return Allocation(*read_pickle(filename))
+
+def write_allocation(pddl_name, allocation, verbose=False):
+    if not SAVE_STATISTICS:
+        return None
+    if USE_DATABASE:
+        path = get_database_path()
+        connection = connect_database(path)
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            row = connection.execute('SELECT search_sample_ratio, max_planner_time, runs FROM allocations '
+                                     'WHERE pddl_name = ?', (pddl_name,)).fetchone()
+            previous, runs = (None, 0) if row is None else (Allocation(*row[:-1]), row[-1])
+            merged = merge_allocations(previous, allocation)
+            connection.execute('INSERT OR REPLACE INTO allocations VALUES (?, ?, ?, ?, ?)',
+                               (pddl_name, merged.search_sample_ratio, merged.max_planner_time,
+                                runs + 1, time.time()))
+            connection.execute('COMMIT')
+        except:
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            raise
+        finally:
+            connection.close()
+    else:
+        path = get_allocation_path(pddl_name)
+        previous = Allocation(*read_pickle(path)) if os.path.exists(path) else None
+        merged = merge_allocations(previous, allocation)
+        ensure_dir(path)
+        write_pickle(path, tuple(merged))
+    if verbose:
+        print('Wrote:', path)
+    return merged
+
+##################################################
+
 def hash_object(evaluations, obj):
     # TODO: hash an object by the DAG of streams that produced it
     # Use this to more finely estimate the parameters of a stream
@@ -191,7 +593,10 @@ class Performance(object):
         # TODO: online learning vs offline learning
         self.online_calls = 0
         self.online_overhead = 0.
+        self.online_overhead_sq = 0.
         self.online_successes = 0
+        self.initial_sketch = LatencySketch()
+        self.online_sketch = LatencySketch()
     @property
     def total_calls(self):
         return self.initial_calls + self.online_calls
@@ -205,10 +610,22 @@ class Performance(object):
         self.initial_calls = statistics['calls']
         self.initial_overhead = statistics['overhead']
         self.initial_successes = statistics['successes']
+        self.initial_sketch = LatencySketch(statistics.get('latencies', {}))
     def update_statistics(self, overhead, success):
         self.online_calls += 1
         self.online_overhead += overhead
+        self.online_overhead_sq += overhead ** 2
         self.online_successes += success
+        self.online_sketch.add(overhead)
+    def get_sketch(self):
+        return self.initial_sketch.merge(self.online_sketch)
+    def get_quantile(self, q):
+        # Quantile of the observed overheads
+        if self.initial_sketch.count and self.online_sketch.count:
+            return self.get_sketch().quantile(q)
+        if self.online_sketch.count:
+            return self.online_sketch.quantile(q)
+        return self.initial_sketch.quantile(q)
     def _estimate_p_success(self, reg_p_success=1., reg_calls=1):
         # TODO: use prior from info instead?
         return safe_ratio(self.total_successes + reg_p_success * reg_calls,
@@ -224,16 +641,19 @@ class Performance(object):
         if self.info.p_success is None:
             return self._estimate_p_success()
         return self.info.p_success
-    def get_overhead(self):
+    def get_overhead(self, quantile=None):
         if self.info.overhead is None:
+            if (quantile is not None) and (MIN_TAIL_CALLS <= len(self.initial_sketch) + len(self.online_sketch)):
+                # Tail-aware overhead that penalizes externals with heavy-tailed runtimes
+                return max(self._estimate_overhead(), self.get_quantile(quantile))
             return self._estimate_overhead()
         return self.info.overhead
     def could_succeed(self):
         return self.get_p_success() > 0
-    def _estimate_effort(self, search_overhead=DEFAULT_SEARCH_OVERHEAD):
-        p_success = self.get_p_success()
-        return geometric_cost(self.get_overhead(), p_success) + \
-               (1 - p_success) * geometric_cost(search_overhead, p_success)
+    def _estimate_effort(self, search_overhead=DEFAULT_SEARCH_OVERHEAD, quantile=None):
+        if quantile is None:
+            quantile = TAIL_QUANTILE
+        return compute_effort(self.get_overhead(quantile=quantile), self.get_p_success(), search_overhead)
     def get_effort(self, **kwargs):
         if self.info.effort is None:
             return self._estimate_effort(**kwargs)
@@ -245,7 +665,7 @@ class Performance(object):
         return Stats(p_success=self.get_p_success(), overhead=sign * self.get_overhead())
     def dump_total(self):
         print('External: {} | n: {:d} | p_success: {:.3f} | overhead: {:.3f}'.format(
-            self.name, self.total_calls, self._estimate_p_success(), self._estimate_overhead()))
+            self.name, int(round(self.total_calls)), self._estimate_p_success(), self._estimate_overhead()))
     def dump_online(self):
         if not self.online_calls:
             return
@@ -314,3 +734,20 @@ class Performance(object):
 #
 #def get_overhead(self):
 #    return self.external.get_overhead()
+
+##################################################
+
+def main():
+    parser = argparse.ArgumentParser(description='Compacts the stream statistics database')
+    parser.add_argument('-p', '--path', type=str, default=None, help='The database path')
+    parser.add_argument('-l', '--half_life', type=float, default=DECAY_HALF_LIFE,
+                        help='Seconds after which previous statistics weigh half as much')
+    parser.add_argument('-b', '--max_buckets', type=int, default=MAX_BUCKETS,
+                        help='The number of latency buckets retained per external')
+    args = parser.parse_args()
+    print('Arguments:', args)
+    path = compact_database(args.path, half_life=args.half_life, max_buckets=args.max_buckets)
+    print('Compacted:', path)
+
+if __name__ == '__main__':
+    main()
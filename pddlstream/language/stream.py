@@ -1,6 +1,10 @@
 import time
 
-from collections import Counter
+from collections import Counter, deque
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError: # Python 2 without the futures backport
+    ThreadPoolExecutor = None
 try:
     from collections import Sequence
 except ImportError:
@@ -13,10 +17,12 @@ from pddlstream.language.conversion import list_from_conjunction, substitute_exp
     get_formula_operators, values_from_objects, obj_from_value_expression, evaluation_from_fact, \
     objects_from_values, substitute_fact
 from pddlstream.language.external import ExternalInfo, Result, Instance, External, DEBUG, SHARED_DEBUG, DEBUG_MODES, \
-    get_procedure_fn, parse_lisp_list, select_inputs, convert_constants
+    DEFAULT_BATCH_SIZE, get_procedure_fn, parse_lisp_list, select_inputs, convert_constants
 from pddlstream.language.generator import get_next, from_fn, universe_test, from_test, BoundedGenerator
-from pddlstream.language.object import Object, OptimisticObject, UniqueOptValue, SharedOptValue, DebugValue, SharedDebugValue
-from pddlstream.utils import str_from_object, get_mapping, irange, apply_mapping, safe_apply_mapping, safe_zip
+from pddlstream.language.object import Object, OptimisticObject, UniqueOptValue, SharedOptValue, DebugValue, \
+    SharedDebugValue, CANONICAL_DIGITS
+from pddlstream.utils import str_from_object, get_mapping, irange, apply_mapping, safe_apply_mapping, \
+    elapsed_time, hash_value, quantize_value
 
 VERBOSE_FAILURES = True
 VERBOSE_WILD = False
@@ -24,6 +30,13 @@ DEFAULT_UNIQUE = False
 NEGATIVE_BLOCKED = True
 NEGATIVE_SUFFIX = '-negative'
 CACHE_OPTIMISTIC = True
+PREFETCH_WORKERS = 4
+PREFETCH_OVERHEAD = 1e-3 # Streams that are cheaper than this on average are not worth prefetching
+
+EXACT = 'exact' # Equal contents
+HASHED = 'hashed' # Equal contents after rounding floats to CANONICAL_DIGITS
+TOLERANCE = 'tolerance' # Floats within the same grid cell of width dedup_tolerance
+DEDUP_MODES = [None, EXACT, HASHED, TOLERANCE]
 
 # TODO: could also make only wild facts and automatically identify output tuples satisfying certified
 # TODO: default effort cost of streams with more inputs to be higher (but negated are free)
@@ -40,6 +53,67 @@ def get_constant_fn(constant):
 def get_identity_fn(indices):
     return lambda *input_values: tuple(input_values[i] for i in indices)
 
+PREFETCH_EXECUTOR = None
+
+def get_prefetch_executor():
+    global PREFETCH_EXECUTOR
+    if PREFETCH_EXECUTOR is None:
+        PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+    return PREFETCH_EXECUTOR
+
+##################################################
+
+class OutputDeduplicator(object):
+    """
+    Maps equivalent output tuples that are produced by different instances of a stream to the same output Objects.
+    The certified facts of a duplicate output that only mention its outputs are then already present,
+    which avoids new evaluations and the downstream instances that they would produce.
+    """
+    def __init__(self, mode=EXACT, tolerance=1e-6):
+        assert mode in DEDUP_MODES[1:]
+        self.mode = mode
+        self.tolerance = tolerance
+        self.entries = {} # key -> (instance, output_objects)
+        self.num_outputs = 0
+        self.num_duplicates = 0 # Outputs whose Objects were reused from another instance
+        self.num_facts = 0 # Certified facts that were already present when adding duplicate outputs
+    def get_key(self, output_values):
+        output_values = tuple(output_values)
+        if self.mode == HASHED:
+            return hash_value(output_values, ndigits=CANONICAL_DIGITS)
+        if self.mode == TOLERANCE:
+            # TODO: values within tolerance that straddle a cell boundary are treated as distinct
+            return hash_value(quantize_value(output_values, self.tolerance))
+        return hash_value(output_values)
+    def get_output_objects(self, instance, output_values):
+        self.num_outputs += 1
+        key = self.get_key(output_values)
+        if key is None: # Unhashable contents
+            return objects_from_values(output_values), False
+        if key not in self.entries:
+            self.entries[key] = (instance, objects_from_values(output_values))
+            return self.entries[key][1], False
+        original, output_objects = self.entries[key]
+        duplicate = (original is not instance)
+        self.num_duplicates += duplicate
+        return output_objects, duplicate
+    def get_statistics(self):
+        return {
+            'outputs': self.num_outputs,
+            'duplicates': self.num_duplicates,
+            'facts': self.num_facts,
+        }
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self.mode)
+
+def get_dedup_statistics(externals):
+    statistics = {'dedup_outputs': 0, 'dedup_duplicates': 0, 'dedup_facts': 0}
+    for external in externals:
+        if getattr(external, 'deduplicator', None) is not None:
+            for name, value in external.deduplicator.get_statistics().items():
+                statistics['dedup_{}'.format(name)] += value
+    return statistics
+
 ##################################################
 
 class PartialInputs(object):
@@ -146,6 +220,7 @@ class FluentOutput(object): # TODO: unify with OptimizerOutput
 
 class StreamInfo(ExternalInfo):
     def __init__(self, opt_gen_fn=None, negate=False, simultaneous=False,
+                 batch_test=None, batch_size=DEFAULT_BATCH_SIZE, prefetch=0, dedup=None, dedup_tolerance=1e-6,
                  verbose=True, **kwargs): # TODO: set negate to None to express no user preference
         # TODO: could change frequency/priority for the incremental algorithm
         # TODO: maximum number of evaluations per iteration of adaptive
@@ -154,6 +229,16 @@ class StreamInfo(ExternalInfo):
         self.opt_gen_fn = PartialInputs() if opt_gen_fn is None else opt_gen_fn
         self.negate = negate
         self.simultaneous = simultaneous
+        # A vectorized test procedure from a list of input value tuples to a boolean mask
+        self.batch_test = batch_test
+        self.batch_size = batch_size
+        # The maximum number of outputs drawn in the background before they are requested
+        # Applies after an instance's first call unless the measured mean overhead is below PREFETCH_OVERHEAD
+        self.prefetch = prefetch
+        # Collapses equivalent outputs from different instances (see DEDUP_MODES)
+        assert dedup in DEDUP_MODES
+        self.dedup = dedup
+        self.dedup_tolerance = dedup_tolerance
         self.verbose = verbose
         # TODO: make this false by default for negated test streams
         #self.order = 0
@@ -161,12 +246,14 @@ class StreamInfo(ExternalInfo):
 ##################################################
 
 class StreamResult(Result):
+    __slots__ = ['output_objects', 'list_index', 'duplicate', '_mapping', '_certified', '_stream_fact']
     def __init__(self, instance, output_objects, opt_index=None,
                  call_index=None, list_index=None, optimistic=True):
         super(StreamResult, self).__init__(instance, opt_index, call_index, optimistic)
         self.output_objects = tuple(output_objects)
         assert len(self.output_objects) == len(self.external.outputs)
         self.list_index = list_index
+        self.duplicate = False # Whether output_objects were reused from an equivalent output of another instance
         self._mapping = None
         self._certified = None
         self._stream_fact = None
@@ -215,6 +302,7 @@ class StreamResult(Result):
 
 class StreamInstance(Instance):
     _Result = StreamResult
+    _Output = WildOutput
     def __init__(self, stream, input_objects, fluent_facts):
         super(StreamInstance, self).__init__(stream, input_objects)
         self._generator = None
@@ -224,6 +312,8 @@ class StreamInstance(Instance):
         self.opt_gens = len(self.opt_gen_fns)*[None]
         self._axiom_predicate = None
         self._disabled_axiom = None
+        self._prefetch = None # Future for outputs that are being drawn in the background
+        self._prefetched = deque() # Drawn (output, enumerated, overhead) tuples that have yet to be requested
         # TODO: keep track of unique outputs to prune repeated ones
 
     def _check_output_values(self, new_values):
@@ -257,6 +347,15 @@ class StreamInstance(Instance):
         return self._Result(instance=self, output_objects=tuple(output_objects), opt_index=opt_index,
                             call_index=call_index, list_index=list_index, optimistic=optimistic)
 
+    def encode_results(self, results):
+        return [(tuple(obj.pddl for obj in result.output_objects), result.opt_index,
+                 result.call_index, result.list_index, result.optimistic) for result in results]
+
+    def decode_results(self, data):
+        return [self._Result(instance=self, output_objects=tuple(map(Object.from_name, output_names)),
+                             opt_index=opt_index, call_index=call_index, list_index=list_index, optimistic=optimistic)
+                for output_names, opt_index, call_index, list_index, optimistic in data]
+
     def get_all_input_objects(self): # TODO: lazily compute
         return set(self.input_objects) | {o for f in self.fluent_facts for o in get_args(f)}
 
@@ -272,14 +371,65 @@ class StreamInstance(Instance):
                 self._generator = self.external.gen_fn(*input_values)
         return self._generator
 
+    def can_prefetch(self):
+        return (ThreadPoolExecutor is not None) and not self.enumerated and not self.external.is_batched and \
+               not (self._prefetched and self._prefetched[-1][1])
+
+    def should_prefetch(self):
+        # Instances that have already been requested are likely to be requested again by other bindings
+        if (self.info.prefetch <= len(self._prefetched)) or (self.num_calls == 0) or not self.can_prefetch():
+            return False
+        if not self.external.could_succeed():
+            return False
+        # Only a measured overhead overrides an explicit prefetch, as the default overhead is EPSILON
+        measured = (self.info.overhead is None) and (0 < self.external.total_calls)
+        return (not measured) or (PREFETCH_OVERHEAD <= self.external.get_overhead())
+
+    def _prefetch_outputs(self, num):
+        # Runs in a background thread and only produces values, so Objects are still created on the main thread
+        outputs = []
+        for _ in range(num):
+            start_time = time.time()
+            output, enumerated = get_next(self._generator, default=[])
+            outputs.append((output, enumerated, elapsed_time(start_time)))
+            if enumerated:
+                break
+        return outputs
+
+    def prefetch(self, num=None):
+        # Draws outputs in the background until num are buffered (by default, info.prefetch if should_prefetch)
+        if self._prefetch is not None:
+            return self._prefetch
+        if num is None:
+            num = self.info.prefetch if self.should_prefetch() else 0
+        if (num <= len(self._prefetched)) or not self.can_prefetch():
+            return None
+        self._create_generator()
+        self._prefetch = get_prefetch_executor().submit(self._prefetch_outputs, num - len(self._prefetched))
+        return self._prefetch
+
+    def _get_next(self):
+        if self._prefetch is not None:
+            future, self._prefetch = self._prefetch, None
+            self._prefetched.extend(future.result()) # Blocks until the background draws finish
+        if self._prefetched:
+            output, enumerated, self.batch_overhead = self._prefetched.popleft()
+            return output, enumerated
+        return get_next(self._generator, default=[])
+
     def _next_wild(self):
-        output, self.enumerated = get_next(self._generator, default=[])
+        output, self.enumerated = self._get_next()
         if not isinstance(output, WildOutput):
             output = WildOutput(values=output)
         return output
 
     def _next_outputs(self):
         # TODO: deprecate
+        if self.external.is_batched:
+            if self.num_calls == len(self.history):
+                self.external.batch_evaluate(self)
+            self.enumerated = True
+            return self.history[self.num_calls]
         self._create_generator()
         # TODO: shuffle history
         # TODO: return all test stream outputs at once
@@ -301,6 +451,19 @@ class StreamInstance(Instance):
                 self.get_iteration(), self.external.name, str_from_object(self.get_input_values()),
                 new_facts, len(new_facts)))
 
+    def _get_output_objects(self, new_values):
+        deduplicator = self.external.deduplicator
+        if deduplicator is None:
+            return [objects_from_values(output_values) for output_values in new_values], set()
+        objects = []
+        duplicates = set()
+        for output_values in new_values:
+            output_objects, duplicate = deduplicator.get_output_objects(self, output_values)
+            objects.append(output_objects)
+            if duplicate:
+                duplicates.add(output_objects)
+        return objects, duplicates
+
     def next_results(self, verbose=False):
         assert not self.enumerated
         start_time = time.time()
@@ -312,16 +475,23 @@ class StreamInstance(Instance):
             self.dump_new_values(new_values)
             self.dump_new_facts(new_facts)
 
-        objects = [objects_from_values(output_values) for output_values in new_values]
+        objects, duplicates = self._get_output_objects(new_values)
         new_objects = list(filter(lambda o: o not in self.previous_outputs, objects))
         self.previous_outputs.update(new_objects) # Only counting new outputs as successes
         new_results = [self.get_result(output_objects, list_index=list_index, optimistic=False)
                        for list_index, output_objects in enumerate(new_objects)]
-        if start_history <= len(self.history) - 1:
+        for result in new_results:
+            result.duplicate = result.output_objects in duplicates
+        if self.batch_overhead is not None:
+            # Evaluated within a batch or prefetched, possibly prior to this call
+            self.update_statistics(start_time, new_results, overhead=self.batch_overhead)
+            self.batch_overhead = None
+        elif start_history <= len(self.history) - 1:
             self.update_statistics(start_time, new_results)
         new_facts = list(map(obj_from_value_expression, new_facts))
         self.successful |= any(r.is_successful() for r in new_results)
         self.num_calls += 1 # Must be after get_result
+        self.prefetch() # Overlaps drawing the next outputs with search and other streams
         #if self.external.is_test and self.successful:
         #    # Set of possible test stream outputs is exhausted (excluding wild)
         #   self.enumerated = True
@@ -490,6 +660,9 @@ class Stream(External):
         else:
             self.blocked_predicate = '~{}'.format(self.name)
         self.disabled_instances = [] # For tracking disabled axioms
+        self.deduplicator = None
+        if self.info.dedup is not None:
+            self.deduplicator = OutputDeduplicator(mode=self.info.dedup, tolerance=self.info.dedup_tolerance)
         self.stream_fact = Fact('_{}'.format(name), concatenate(inputs, outputs)) # TODO: just add to certified?
 
         if self.is_negated:
@@ -520,14 +693,25 @@ class Stream(External):
     @property
     def is_function(self):
         return False
+    @property
+    def is_batched(self):
+        return self.is_test and not self.is_fluent and (self.info.batch_test is not None)
     def get_instance(self, input_objects, fluent_facts=frozenset()):
         input_objects = tuple(input_objects)
         fluent_facts = frozenset(fluent_facts)
         assert all(isinstance(obj, Object) or isinstance(obj, OptimisticObject) for obj in input_objects)
         key = (input_objects, fluent_facts)
         if key not in self.instances:
-            self.instances[key] = self._Instance(self, input_objects, fluent_facts)
+            # setdefault is atomic, so concurrent callers share one instance
+            instance = self._Instance(self, input_objects, fluent_facts)
+            if self.instances.setdefault(key, instance) is instance:
+                self.queue_batch(instance)
         return self.instances[key]
+    def batch_evaluate(self, instance):
+        outputs = self.evaluate_batch(instance, self.info.batch_test, batch_size=self.info.batch_size)
+        for other, success in outputs:
+            other.history.append(WildOutput(values=[tuple()] if success else [], enumerated=True))
+        return outputs
     def as_test_stream(self):
         # TODO: method that converts a stream into a test stream (possibly from ss)
         raise NotImplementedError()
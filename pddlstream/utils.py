@@ -14,6 +14,10 @@ import io
 from collections import defaultdict, deque, Counter, namedtuple
 from itertools import count
 from heapq import heappush, heappop
+try:
+    from collections import Sized
+except ImportError:
+    from collections.abc import Sized
 
 import numpy as np
 
@@ -360,6 +364,107 @@ class HeapElement(Comparable):
     def __repr__(self):
         return '{}({}, {})'.format(self.__class__.__name__, self.key, self.value)
 
+class AddressableHeap(Sized):
+    """
+    A binary min-heap of HeapElements with a position map from each value to its index.
+    Pushing a value that is already present updates its key in place, so the heap never holds garbage copies.
+    Invalidated values keep their old key until the heap is next queried, when priority_fn recomputes it.
+    """
+    def __init__(self, priority_fn=None):
+        self.priority_fn = priority_fn
+        self.elements = []
+        self.positions = {}
+        self.stale = set()
+    def __len__(self):
+        return len(self.elements)
+    def __contains__(self, value):
+        return value in self.positions
+    def __iter__(self):
+        return iter(self.elements)
+    @property
+    def num_stale(self):
+        return len(self.stale)
+    def _set(self, index, element):
+        self.elements[index] = element
+        self.positions[element.value] = index
+    def _sift_up(self, index):
+        element = self.elements[index]
+        while 0 < index:
+            parent = (index - 1) // 2
+            if not (element < self.elements[parent]):
+                break
+            self._set(index, self.elements[parent])
+            index = parent
+        self._set(index, element)
+    def _sift_down(self, index):
+        element = self.elements[index]
+        while True:
+            child = 2*index + 1
+            if len(self.elements) <= child:
+                break
+            if ((child + 1) < len(self.elements)) and (self.elements[child + 1] < self.elements[child]):
+                child += 1
+            if not (self.elements[child] < element):
+                break
+            self._set(index, self.elements[child])
+            index = child
+        self._set(index, element)
+    def push(self, key, value):
+        # O(log n) insertion or update
+        self.stale.discard(value)
+        if value not in self.positions:
+            self.elements.append(None)
+            self._set(len(self.elements) - 1, HeapElement(key, value))
+            self._sift_up(len(self.elements) - 1)
+            return
+        index = self.positions[value]
+        old_element = self.elements[index]
+        self._set(index, HeapElement(key, value))
+        if key < old_element.key:
+            self._sift_up(index)
+        else:
+            self._sift_down(index)
+    def remove(self, value):
+        # O(log n) removal of an arbitrary value
+        index = self.positions.pop(value)
+        self.stale.discard(value)
+        element = self.elements[index]
+        last_element = self.elements.pop()
+        if index < len(self.elements):
+            self._set(index, last_element)
+            if last_element < element:
+                self._sift_up(index)
+            else:
+                self._sift_down(index)
+        return element
+    def invalidate(self, test=lambda value: True):
+        for element in self.elements:
+            if test(element.value):
+                self.stale.add(element.value)
+    def _refresh(self):
+        # Defers recomputation so that several invalidations are coalesced
+        for value in list(self.stale):
+            self.push(self.priority_fn(value), value)
+    def peek(self):
+        self._refresh()
+        return self.elements[0]
+    def pop(self):
+        element = self.peek()
+        self.remove(element.value)
+        return element
+    def peek_elements(self, num):
+        # The num smallest elements in order without popping them (visits O(num) nodes)
+        self._refresh()
+        elements = []
+        frontier = [HeapElement(self.elements[0], 0)] if self.elements else []
+        while frontier and (len(elements) < num):
+            element, index = heappop(frontier)
+            elements.append(element)
+            for child in [2*index + 1, 2*index + 2]:
+                if child < len(self.elements):
+                    heappush(frontier, HeapElement(self.elements[child], child))
+        return elements
+
 ##################################################
 
 def sorted_str_from_list(obj, **kwargs):
@@ -614,6 +719,41 @@ def value_or_id(value):
     return id(value)
 
 
+def hash_value(value, ndigits=None):
+    # Hashable key for the contents of a value (e.g. a numpy array) or None if its contents cannot be hashed
+    # TODO: rounding assigns nearly equal values that straddle a rounding boundary to different keys
+    if (ndigits is not None) and isinstance(value, float):
+        return round(value, ndigits) + 0. # NOTE - catches -0.0 bug
+    if (ndigits is None) and is_hashable(value):
+        return value
+    if isinstance(value, np.ndarray):
+        if value.dtype == object:
+            return hash_value(value.tolist(), ndigits=ndigits)
+        array = value
+        if (ndigits is not None) and np.issubdtype(array.dtype, np.floating):
+            array = np.round(array, decimals=ndigits) + 0.
+        return (np.ndarray, array.dtype.str, array.shape, array.tobytes())
+    if isinstance(value, (list, tuple)):
+        keys = tuple(hash_value(item, ndigits=ndigits) for item in value)
+        if any((key is None) and (item is not None) for key, item in zip(keys, value)):
+            return None
+        return (type(value), keys)
+    if is_hashable(value):
+        return value
+    return None
+
+
+def quantize_value(value, resolution):
+    # Replaces floats (including within numpy arrays) with the index of their grid cell of width resolution
+    if isinstance(value, float):
+        return int(math.floor(value / resolution))
+    if isinstance(value, np.ndarray) and np.issubdtype(value.dtype, np.floating):
+        return np.floor(value / resolution).astype(np.int64)
+    if isinstance(value, (list, tuple)):
+        return type(value)(quantize_value(item, resolution) for item in value)
+    return value
+
+
 def is_64bits():
     #return sys.maxsize > 2**32
     import platform